@@ -0,0 +1,140 @@
+from collections import Counter
+
+import pandas as pd
+
+
+# metrics summed by group_critdat
+CRIT_METRICS = ['tubes_inspected', 'bins_collected', 'critical_tubes', 'critical_bins']
+
+
+# key of a row in one grouping, missing levels as None
+def _group_key(row, groupon_list):
+    return tuple(None if pd.isna(row[column]) else row[column] for column in groupon_list)
+
+
+class _Group:
+    """
+    Running sums of one group and the inspections (slug multiplicity) in it
+    """
+
+    def __init__(self, n_metrics):
+        self.sums = [0]*n_metrics
+        self.slugs = Counter()
+
+    def add(self, inspection_slug, values, sign=1):
+        for i, value in enumerate(values):
+            self.sums[i] += sign*value
+        self.slugs[inspection_slug] += sign
+        if self.slugs[inspection_slug] <= 0:
+            del self.slugs[inspection_slug]
+
+
+class FleetAggregator:
+    """
+    Incremental version of group_critdat for several groupings at once
+
+    Keeps per group running sums of the metrics and the distinct inspections,
+    for every grouping in hierarchies. Adding or retracting an inspection
+    touches one group per grouping, and a roll-up is read from the groups
+    without rescanning the combined frame.
+
+    inputs:
+        - hierarchies - list of groupon_lists (ie [['customer'],
+          ['customer', 'unit'], ['component_type']])
+        - metrics - columns to sum (default CRIT_METRICS)
+    """
+
+    def __init__(self, hierarchies, metrics=CRIT_METRICS):
+        self.hierarchies = [tuple(groupon_list) for groupon_list in hierarchies]
+        self.metrics = list(metrics)
+        self._groups = {groupon_list: {} for groupon_list in self.hierarchies}
+        # rows added per slug, to retract them
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, inspection_slug):
+        return inspection_slug in self._rows
+
+    def _apply(self, inspection_slug, row, sign):
+        # missing metrics count as 0, as in a groupby sum
+        values = [0 if pd.isna(row[metric]) else row[metric] for metric in self.metrics]
+        for groupon_list, groups in self._groups.items():
+            key = _group_key(row, groupon_list)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _Group(len(self.metrics))
+            group.add(inspection_slug, values, sign)
+            if not group.slugs:
+                del groups[key]
+
+    def add(self, row):
+        """
+        Add one row of comb_df (a dict or Series with slug, the grouping
+        columns and the metrics); a slug may be added with several rows
+        """
+        row = {column: row[column] for column in self._columns()}
+        self._rows.setdefault(row['slug'], []).append(row)
+        self._apply(row['slug'], row, 1)
+
+    def add_frame(self, comb_df):
+        """
+        Add every row of a comb_df (ie a new batch of check_thickness results
+        merged with reference data)
+        """
+        for row in comb_df[self._columns()].to_dict('records'):
+            self._rows.setdefault(row['slug'], []).append(row)
+            self._apply(row['slug'], row, 1)
+
+    def retract(self, inspection_slug):
+        """
+        Remove all rows of an inspection (ie before adding it again with
+        corrected reference data)
+
+        raises:
+            - KeyError if the slug was never added
+        """
+        for row in self._rows.pop(inspection_slug):
+            self._apply(inspection_slug, row, -1)
+
+    def _columns(self):
+        columns = ['slug']
+        for groupon_list in self.hierarchies:
+            columns += [column for column in groupon_list if column not in columns]
+        return columns + [metric for metric in self.metrics if metric not in columns]
+
+    def _rollup_groups(self, groupon_list):
+        if groupon_list in self._groups:
+            return self._groups[groupon_list]
+
+        # coarser grouping of a tracked one: merge its groups
+        for tracked in self.hierarchies:
+            if set(groupon_list) <= set(tracked):
+                positions = [tracked.index(column) for column in groupon_list]
+                groups = {}
+                for key, child in self._groups[tracked].items():
+                    parent_key = tuple(key[position] for position in positions)
+                    group = groups.get(parent_key)
+                    if group is None:
+                        group = groups[parent_key] = _Group(len(self.metrics))
+                    group.sums = [total + value for total, value in zip(group.sums, child.sums)]
+                    group.slugs.update(child.slugs)
+                return groups
+        raise KeyError(f'{list(groupon_list)} is not a grouping of this aggregator')
+
+    def rollup(self, groupon_list):
+        """
+        Return the grouped df of a grouping, as group_critdat(comb_df,
+        groupon_list) on all rows added so far
+
+        groupon_list is one of the hierarchies, or a subset of the columns of
+        one (ie ['customer'] from ['customer', 'unit']).
+        """
+        groupon_list = tuple(groupon_list)
+        groups = self._rollup_groups(groupon_list)
+        # keys with a missing level are kept for coarser roll-ups, but dropped
+        # here as groupby does
+        keys = sorted(key for key in groups if None not in key)
+        data_list = [list(key) + [len(groups[key].slugs)] + groups[key].sums for key in keys]
+        return pd.DataFrame(data_list, columns=list(groupon_list) + ['inspections'] + self.metrics)
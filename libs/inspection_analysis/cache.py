@@ -0,0 +1,239 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from ..inspection_analysis.decode import inspection_df_from_response
+from ..inspection_analysis.fetch import DEFAULT_TIMEOUT, request_binned_plot_data
+
+
+# default location of the inspection cache
+DEFAULT_CACHE_ROOT = Path.home() / ".cache" / "davos" / "inspections"
+
+# seconds a cached slug is served from disk without asking the portal (a
+# fleet rebuild within a session reads from disk); after that it is
+# revalidated with its ETag, or downloaded again if the portal sent none
+DEFAULT_TTL = 3600
+
+
+class InspectionCache:
+    """
+    Local on-disk cache of inspection binned plot data, keyed by slug
+
+    Each slug is stored as <slug>.parquet (zstd compressed columns) next to a
+    <slug>.json sidecar with the fetch time, ETag, size and row count. The
+    sidecar mtime is the last access time used for LRU eviction.
+
+    inputs:
+        - root - cache directory
+        - ttl - seconds before a cached slug is revalidated with the portal
+          (using its ETag), default DEFAULT_TTL; None never expires
+        - max_bytes - evict least recently used slugs beyond this size; None
+          is unbounded
+        - offline - never touch the network, missing slugs raise LookupError
+    """
+
+    def __init__(self, root=DEFAULT_CACHE_ROOT, ttl=DEFAULT_TTL, max_bytes=None, offline=False):
+        self.root = Path(root)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.root.mkdir(parents=True, exist_ok=True)
+        # guards the byte count and removals (evict removes under it)
+        self._lock = threading.RLock()
+        self._total_bytes = sum(meta.get('size', 0) for _, meta in self._entries())
+        # the directory may be over max_bytes already (ie a lower limit)
+        self.evict()
+
+    def _data_path(self, inspection_slug):
+        return self.root / f"{inspection_slug}.parquet"
+
+    def _meta_path(self, inspection_slug):
+        return self.root / f"{inspection_slug}.json"
+
+    def _entries(self):
+        for meta_path in self.root.glob('*.json'):
+            try:
+                yield meta_path, json.loads(meta_path.read_text())
+            except (OSError, ValueError):
+                continue
+
+    def metadata(self, inspection_slug):
+        """
+        Return the sidecar metadata of a cached slug, or None
+        """
+        try:
+            return json.loads(self._meta_path(inspection_slug).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, inspection_slug, meta):
+        # replaced in one step so readers never see a partial sidecar
+        tmp_path = self._meta_path(inspection_slug).with_suffix(f'.json.{threading.get_ident()}.tmp')
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, self._meta_path(inspection_slug))
+
+    def is_fresh(self, meta):
+        return self.ttl is None or time.time() - meta['fetched_at'] < self.ttl
+
+    def read(self, inspection_slug, meta=None):
+        """
+        Return the cached inspection_df (None for slugs that returned no data)
+
+        raises:
+            - LookupError if the slug is not cached (or was just evicted)
+        """
+        meta = meta or self.metadata(inspection_slug)
+        if meta is None:
+            raise LookupError(f"{inspection_slug} is not cached")
+        try:
+            # touch the sidecar: last access for LRU eviction
+            os.utime(self._meta_path(inspection_slug))
+            if meta['empty']:
+                return None
+            return pd.read_parquet(self._data_path(inspection_slug))
+        except FileNotFoundError:
+            raise LookupError(f"{inspection_slug} was removed from the cache") from None
+
+    def put(self, inspection_slug, inspection_df, etag=None):
+        """
+        Store an inspection_df (or None for an empty payload)
+        """
+        size = 0
+        tmp_path = None
+        if inspection_df is not None:
+            tmp_path = self._data_path(inspection_slug).with_suffix(f'.parquet.{threading.get_ident()}.tmp')
+            inspection_df.to_parquet(tmp_path, compression='zstd', index=False)
+            size = tmp_path.stat().st_size
+
+        meta = {
+            'slug': inspection_slug,
+            'fetched_at': time.time(),
+            'etag': etag,
+            'size': size,
+            'rows': 0 if inspection_df is None else len(inspection_df),
+            'empty': inspection_df is None,
+        }
+        # data and sidecar change together, so a remove never splits them
+        with self._lock:
+            old = self.metadata(inspection_slug)
+            if tmp_path is not None:
+                os.replace(tmp_path, self._data_path(inspection_slug))
+            else:
+                try:
+                    self._data_path(inspection_slug).unlink()
+                except FileNotFoundError:
+                    pass
+            self._write_meta(inspection_slug, meta)
+            self._total_bytes += size - (old['size'] if old else 0)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used slugs until the cache fits in max_bytes
+        """
+        if self.max_bytes is None or self._total_bytes <= self.max_bytes:
+            return
+        with self._lock:
+            entries = []
+            for meta_path, meta in self._entries():
+                try:
+                    entries.append((meta_path.stat().st_mtime, meta['slug']))
+                except FileNotFoundError:
+                    # removed since it was listed
+                    continue
+            for _, inspection_slug in sorted(entries):
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self.remove(inspection_slug)
+
+    def remove(self, inspection_slug):
+        """
+        Remove a slug from the cache (a get reading it then fetches it again)
+        """
+        with self._lock:
+            meta = self.metadata(inspection_slug)
+            for path in (self._meta_path(inspection_slug), self._data_path(inspection_slug)):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            if meta is not None:
+                self._total_bytes -= meta['size']
+
+    def get(self, inspection_slug, session=None, timeout=DEFAULT_TIMEOUT, url_start=None):
+        """
+        Return the inspection_df of a slug, reading through the cache
+
+        Fresh entries are read from disk; stale entries are revalidated with
+        their ETag and only downloaded again if they changed.
+
+        outputs:
+            - inspection_df, or None if the portal returned no data
+        raises:
+            - LookupError in offline mode if the slug is not cached
+            - the fetch errors of request_binned_plot_data and
+              inspection_df_from_response
+        """
+        meta = self.metadata(inspection_slug)
+        if meta is not None and (self.offline or self.is_fresh(meta)):
+            try:
+                return self.read(inspection_slug, meta)
+            except LookupError:
+                if self.offline:
+                    raise
+                meta = None
+        if self.offline:
+            raise LookupError(f"{inspection_slug} is not cached (offline mode)")
+
+        etag = meta['etag'] if meta is not None else None
+        with request_binned_plot_data(inspection_slug, session, timeout, url_start, etag=etag, stream=True) as req:
+            if req.status_code != 304:
+                inspection_df = inspection_df_from_response(req)
+                self.put(inspection_slug, inspection_df, etag=req.headers.get('ETag'))
+                return inspection_df
+
+        # unchanged, restart the ttl
+        meta['fetched_at'] = time.time()
+        try:
+            with self._lock:
+                if self.metadata(inspection_slug) is None:
+                    raise LookupError(inspection_slug)
+                self._write_meta(inspection_slug, meta)
+            return self.read(inspection_slug, meta)
+        except LookupError:
+            # evicted while revalidating, download it again
+            with request_binned_plot_data(inspection_slug, session, timeout, url_start, stream=True) as req:
+                inspection_df = inspection_df_from_response(req)
+            self.put(inspection_slug, inspection_df, etag=req.headers.get('ETag'))
+            return inspection_df
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+# shared cache used by the inspection_analysis utils
+def get_default_cache():
+    """
+    Return the cache used when no cache is passed, created on first use
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = InspectionCache()
+    return _default_cache
+
+
+# configure the shared cache
+def configure_cache(root=DEFAULT_CACHE_ROOT, ttl=DEFAULT_TTL, max_bytes=None, offline=False):
+    """
+    Replace the shared cache, see InspectionCache for the options
+    """
+    global _default_cache
+    with _default_cache_lock:
+        _default_cache = InspectionCache(root, ttl, max_bytes, offline)
+    return _default_cache
@@ -0,0 +1,326 @@
+import numpy as np
+import pandas as pd
+
+from ..inspection_analysis.cache import get_default_cache
+from ..inspection_analysis.fetch import DEFAULT_MAX_WORKERS, fetch_many
+
+
+# days in a year, for loss rates
+DAYS_PER_YEAR = 365.25
+
+
+# one row per bin cell, with the min thickness of the cell
+def _cells(inspection_df, on):
+    columns = {'thickness': ('thickness', 'min')}
+    if 'customer_x' not in on:
+        columns['customer_x'] = ('customer_x', 'first')
+    return inspection_df.groupby(list(on), sort=False, observed=True).agg(**columns).reset_index()
+
+
+# cell offsets within tolerance, nearest first
+def _offsets(tolerance):
+    steps = np.arange(-tolerance, tolerance + 1)
+    dx, dy = [grid.ravel() for grid in np.meshgrid(steps, steps)]
+    order = np.lexsort((dy, dx, np.hypot(dx, dy)))
+    return list(zip(dx[order], dy[order]))
+
+
+class _BinIndex:
+    """
+    Sorted linear cell ids of a bin grid, to look up shifted cells of another
+    grid (on the same origin, with room for shifts up to margin)
+    """
+
+    def __init__(self, before_xy, after_xy, margin):
+        self.lo = np.minimum(before_xy.min(axis=0), after_xy.min(axis=0)) - margin
+        self.width = int(max(before_xy[:, 0].max(), after_xy[:, 0].max()) - self.lo[0] + margin + 1)
+        ids = self.ids(before_xy)
+        self.order = np.argsort(ids)
+        self.sorted_ids = ids[self.order]
+
+    def ids(self, xy):
+        return (xy[:, 1] - self.lo[1])*self.width + (xy[:, 0] - self.lo[0])
+
+    def lookup(self, ids):
+        """
+        Return the before cell of each id, -1 if there is none
+        """
+        positions = np.minimum(np.searchsorted(self.sorted_ids, ids), len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[positions] == ids, self.order[positions], -1)
+
+
+# match after cells to the nearest before cell within offsets
+def _match_bins(before_xy, after_xy, offsets):
+    margin = max(max(abs(dx), abs(dy)) for dx, dy in offsets)
+    index = _BinIndex(before_xy, after_xy, margin)
+    # sorted lookups are much faster, and a shift keeps them sorted
+    after_order = np.argsort(index.ids(after_xy))
+    after_ids = index.ids(after_xy)[after_order]
+
+    matches = np.full(len(after_ids), -1, dtype=np.int64)
+    for dx, dy in offsets:
+        pending = np.flatnonzero(matches < 0)
+        if len(pending) == 0:
+            break
+        matches[pending] = index.lookup(after_ids[pending] + dy*index.width + dx)
+
+    after_matches = np.empty_like(matches)
+    after_matches[after_order] = matches
+    return after_matches
+
+
+# offset between the bin grids of two inspections
+def estimate_offset(before_df, after_df, max_offset=3, sample=100000):
+    """
+    Take two inspections of a unit and return the (dx, dy) bin offset that
+    best lines them up, ie the most after bins landing on a before bin when
+    (dx, dy) is added to the after bins
+
+    inputs:
+        - before_df, after_df - binned data from the two inspections
+        - max_offset - largest offset tried in x and y
+        - sample - after cells tried (a fixed random sample, for speed)
+    """
+    before_xy = _cells(before_df, ['x_bin', 'y_bin'])[['x_bin', 'y_bin']].to_numpy(np.int64)
+    after_xy = _cells(after_df, ['x_bin', 'y_bin'])[['x_bin', 'y_bin']].to_numpy(np.int64)
+    if len(before_xy) == 0 or len(after_xy) == 0:
+        return (0, 0)
+    if len(after_xy) > sample:
+        after_xy = after_xy[np.random.default_rng(0).choice(len(after_xy), sample, replace=False)]
+
+    index = _BinIndex(before_xy, after_xy, max_offset)
+    after_ids = np.sort(index.ids(after_xy))
+    best, best_count = (0, 0), -1
+    for dx, dy in _offsets(max_offset):
+        count = (index.lookup(after_ids + dy*index.width + dx) >= 0).sum()
+        if count > best_count:
+            best, best_count = (int(dx), int(dy)), count
+    return best
+
+
+# align two inspections of a unit
+def align_inspections(before_df, after_df, on='bins', offset=(0, 0), tolerance=0):
+    """
+    Take two inspections of a unit and pair their bins
+
+    inputs:
+        - before_df, after_df - binned data from the two inspections
+        - on - 'bins' to join on (x_bin, y_bin), or 'customer' to join on
+          customer_x and the nearest customer_y
+        - offset - (dx, dy) added to the after bins to bring them onto the
+          before grid, for on='bins'; 'auto' estimates it for this pair (see
+          estimate_offset)
+        - tolerance - bins an after bin may be off from its before bin (the
+          nearest is taken) for on='bins', or the largest customer_y
+          difference for on='customer'
+    outputs:
+        - aligned_df - one row per after cell with a before match, with
+          columns:
+            - 'customer_x' - tube of the before inspection
+            - 'x_bin', 'y_bin' (on='bins') or 'customer_y' (on='customer')
+              of the before inspection
+            - 'thickness_before', 'thickness_after' - min t of the cells
+            - 'loss' - thickness_before - thickness_after
+    """
+    if on == 'bins':
+        if isinstance(offset, str) and offset == 'auto':
+            offset = estimate_offset(before_df, after_df)
+        before = _cells(before_df, ['x_bin', 'y_bin'])
+        after = _cells(after_df, ['x_bin', 'y_bin'])
+        if before.empty or after.empty:
+            matches = np.full(len(after), -1, dtype=np.int64)
+        else:
+            after_xy = after[['x_bin', 'y_bin']].to_numpy(np.int64) + np.asarray(offset, dtype=np.int64)
+            matches = _match_bins(before[['x_bin', 'y_bin']].to_numpy(np.int64), after_xy, _offsets(tolerance))
+        matched = matches >= 0
+        aligned_df = pd.DataFrame({
+            'customer_x': before.customer_x.to_numpy()[matches[matched]],
+            'x_bin': before.x_bin.to_numpy()[matches[matched]],
+            'y_bin': before.y_bin.to_numpy()[matches[matched]],
+            'thickness_before': before.thickness.to_numpy()[matches[matched]],
+            'thickness_after': after.thickness.to_numpy()[matched],
+        })
+    elif on == 'customer':
+        before = _cells(before_df, ['customer_x', 'customer_y'])[['customer_x', 'customer_y', 'thickness']]
+        after = _cells(after_df, ['customer_x', 'customer_y'])[['customer_x', 'customer_y', 'thickness']]
+        # merge_asof needs the same key types on both sides
+        before['customer_x'] = before.customer_x.astype(str)
+        after['customer_x'] = after.customer_x.astype(str)
+        merged = pd.merge_asof(
+            after.rename(columns={'thickness': 'thickness_after', 'customer_y': 'customer_y_after'}).sort_values('customer_y_after'),
+            before.rename(columns={'thickness': 'thickness_before'}).sort_values('customer_y'),
+            left_on='customer_y_after',
+            right_on='customer_y',
+            by='customer_x',
+            direction='nearest',
+            tolerance=tolerance,
+        ).dropna(subset=['customer_y'])
+        aligned_df = merged[['customer_x', 'customer_y', 'thickness_before', 'thickness_after']].reset_index(drop=True)
+    else:
+        raise ValueError(f"on must be 'bins' or 'customer', not {on!r}")
+
+    aligned_df['loss'] = aligned_df.thickness_before - aligned_df.thickness_after
+    return aligned_df
+
+
+# per tube loss of aligned inspections
+def tube_loss(aligned_df, years=None):
+    """
+    Take an aligned_df and return the loss per tube
+
+    outputs:
+        - df indexed by customer_x with columns:
+            - 'bins' - matched bins
+            - 'min_t_before', 'min_t_after' - min t of the matched bins
+            - 'min_t_loss' - min_t_before - min_t_after
+            - 'max_loss', 'mean_loss' - of the matched bins
+            - 'loss_rate' - min_t_loss per year (if years is given)
+    """
+    grouped = aligned_df.groupby('customer_x', sort=True, observed=True)
+    tube_df = pd.DataFrame({
+        'bins': grouped.size(),
+        'min_t_before': grouped.thickness_before.min(),
+        'min_t_after': grouped.thickness_after.min(),
+        'max_loss': grouped.loss.max(),
+        'mean_loss': grouped.loss.mean(),
+    })
+    tube_df.insert(3, 'min_t_loss', tube_df.min_t_before - tube_df.min_t_after)
+    if years is not None:
+        tube_df['loss_rate'] = tube_df.min_t_loss/years
+    return tube_df
+
+
+# summary of the loss between two inspections
+def compare_inspections(before_df, after_df, years, nominal=None, threshold=None, **align_kwargs):
+    """
+    Take two inspections of a unit years apart and return the fleet summary
+    row of the comparison (a dict)
+
+    inputs:
+        - before_df, after_df - binned data from the two inspections
+        - years - time between the inspections
+        - nominal, threshold - if both given, add 'years_to_threshold', the
+          years until the fastest losing tube reaches nominal*threshold (NaN
+          if no bins matched)
+        - align_kwargs - passed on to align_inspections
+    outputs:
+        - dict with bins_matched, median_loss, p95_loss, max_loss,
+          median_loss_rate, max_tube_loss_rate, min_t_after (and
+          years_to_threshold)
+    """
+    aligned_df = align_inspections(before_df, after_df, **align_kwargs)
+    tube_df = tube_loss(aligned_df, years)
+    loss = aligned_df.loss.to_numpy()
+    has_bins = len(loss) > 0
+    summary = {
+        'bins_matched': len(aligned_df),
+        'median_loss': np.nanmedian(loss) if has_bins else np.nan,
+        'p95_loss': np.nanpercentile(loss, 95) if has_bins else np.nan,
+        'max_loss': np.nanmax(loss) if has_bins else np.nan,
+        'median_loss_rate': np.nanmedian(loss)/years if has_bins else np.nan,
+        'max_tube_loss_rate': tube_df.loss_rate.max() if has_bins else np.nan,
+        'min_t_after': aligned_df.thickness_after.min() if has_bins else np.nan,
+    }
+    if nominal is not None and threshold is not None:
+        rate = summary['max_tube_loss_rate']
+        margin = summary['min_t_after'] - nominal*threshold
+        if np.isnan(rate):
+            # no bins matched, nothing is known about the loss
+            summary['years_to_threshold'] = np.nan
+        else:
+            summary['years_to_threshold'] = max(margin, 0)/rate if rate > 0 else np.inf
+    return summary
+
+
+# compare the consecutive inspections of one unit
+def _compare_unit(unit, session=None, cache=None, unit_columns=(), date_column='date', threshold=None, align_kwargs=None):
+    """
+    Take (unit, rows of its inspections by date) and return (data_list,
+    error_list) of its consecutive pairs, see compare_units; each inspection
+    is fetched once and released after its pairs
+    """
+    unit, unit_rows = unit
+    align_kwargs = align_kwargs or {}
+    data_list = []
+    error_list = []
+    previous = None
+    for row in unit_rows:
+        try:
+            inspection_df = cache.get(row['slug'], session=session)
+            if inspection_df is None:
+                raise ValueError('inspection slug failed to return data')
+        except Exception as e:
+            inspection_df = e
+
+        if previous is not None:
+            before, before_df = previous
+            try:
+                for pair_df in (before_df, inspection_df):
+                    if isinstance(pair_df, Exception):
+                        raise pair_df
+                years = (row[date_column] - before[date_column]).days/DAYS_PER_YEAR
+                summary = compare_inspections(before_df, inspection_df, years, row['nominal'], threshold, **align_kwargs)
+                data = dict(zip(unit_columns, unit))
+                data.update(slug_before=before['slug'], slug_after=row['slug'], years=years)
+                data.update(summary)
+                data_list.append(data)
+            except Exception as e:
+                print('Error: {} -> {} {!r}'.format(before['slug'], row['slug'], e))
+                error_list.append((before['slug'], row['slug'], e))
+        previous = (row, inspection_df)
+    return data_list, error_list
+
+
+# compare every repeat inspected unit
+def compare_units(targets_df, unit_columns, date_column='date', threshold=None, max_workers=DEFAULT_MAX_WORKERS, cache=None, **align_kwargs):
+    """
+    Takes a dataframe of inspections and compares the consecutive inspections
+    of every unit inspected more than once
+
+    inputs:
+        - targets_df - contains slug, nominal, date_column and unit_columns
+        - unit_columns - list of columns identifying a unit (ie ['customer',
+          'site', 'unit', 'component_type'])
+        - date_column - inspection date column
+        - threshold - see compare_inspections
+        - max_workers - number of units fetched and compared concurrently
+        - cache - InspectionCache to read through, defaults to the shared cache
+        - align_kwargs - passed on to align_inspections; the grid offset
+          defaults to 'auto', estimated for every pair (each inspection of a
+          unit may start its bins elsewhere)
+    outputs:
+        - data_df - one row per consecutive pair with the unit_columns,
+          'slug_before', 'slug_after', 'years' and the compare_inspections
+          summary
+        - error_list - list of (slug_before, slug_after, error) of failed pairs
+    """
+    cache = cache or get_default_cache()
+    align_kwargs.setdefault('offset', 'auto')
+    targets_df = targets_df.assign(**{date_column: pd.to_datetime(targets_df[date_column])})
+    targets_df = targets_df.sort_values(list(unit_columns) + [date_column], kind='stable')
+
+    units = [
+        (unit, unit_df.to_dict('records'))
+        for unit, unit_df in targets_df.groupby(list(unit_columns), sort=False, observed=True)
+        if len(unit_df) > 1
+    ]
+
+    # units are compared concurrently, each holding at most two of its
+    # inspections at a time, so only the units in flight are in memory
+    results = {}
+    compared = fetch_many(
+        units, fetch=_compare_unit, max_workers=max_workers,
+        cache=cache, unit_columns=unit_columns, date_column=date_column, threshold=threshold, align_kwargs=align_kwargs,
+    )
+    for position, _, result, error in compared:
+        if error is not None:
+            raise error
+        results[position] = result
+
+    data_list = []
+    error_list = []
+    for position in range(len(units)):
+        unit_data, unit_errors = results.pop(position)
+        data_list.extend(unit_data)
+        error_list.extend(unit_errors)
+    return pd.DataFrame(data_list), error_list
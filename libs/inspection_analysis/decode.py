@@ -0,0 +1,222 @@
+import csv
+import io
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+
+# column types of the binned plot data, other columns are inferred
+# (thickness stays float64: the critical counts compare it with nominal
+# fractions and float32 rounding moves bins sitting on a threshold)
+BINNED_PLOT_DTYPES = {
+    'x_bin': np.int32,
+    'y_bin': np.int32,
+    'thickness': np.float64,
+}
+
+# records decoded at once
+DEFAULT_BATCH_BYTES = 4 << 20
+
+_DATA_START = re.compile(rb'"plots"\s*:\s*\[\s*\{.*?"data"\s*:\s*\[', re.S)
+_KEY = re.compile(rb'"([^"\\]*)"\s*:')
+_LINE_BREAK = re.compile(rb'[\r\n]\s*')
+_ESCAPE = re.compile(rb'\\.', re.S)
+
+
+# whether position pos of buffer is outside of json strings
+def _outside_string(buffer, pos):
+    head = buffer[:pos]
+    if b'\\' in head:
+        # drop escapes (ie \" and \\) so the remaining quotes delimit strings
+        head = _ESCAPE.sub(b'', head)
+    return head.count(b'"') % 2 == 0
+
+
+# first closing brace of buffer outside of json strings, -1 if none
+def _first_brace(buffer):
+    end = buffer.find(b'}')
+    while end >= 0 and not _outside_string(buffer, end):
+        end = buffer.find(b'}', end + 1)
+    return end
+
+
+class BinnedPlotDecoder:
+    """
+    Incremental decoder of a binned_plot_data payload into an inspection_df
+
+    Feed the response body in chunks of any size; the records of the first
+    plot are decoded a batch at a time into typed columns (no per bin dicts)
+    and close() returns the inspection_df. The records are expected to be flat
+    objects of numbers and simple strings with the same key order, as the
+    portal sends them; batches that are not (or have escapes, commas or
+    braces in strings) are decoded with json instead.
+
+    inputs:
+        - dtypes - column -> dtype, default BINNED_PLOT_DTYPES
+        - batch_bytes - decode once this many bytes of records are buffered
+    """
+
+    def __init__(self, dtypes=BINNED_PLOT_DTYPES, batch_bytes=DEFAULT_BATCH_BYTES):
+        self.dtypes = dict(dtypes)
+        self.batch_bytes = batch_bytes
+        self._buffer = b''
+        self._in_data = False
+        self._done = False
+        self._columns = None
+        self._batches = []
+
+    def feed(self, data):
+        if self._done or not data:
+            return
+        self._buffer += data
+        if not self._in_data:
+            match = _DATA_START.search(self._buffer)
+            if match is None:
+                return
+            self._in_data = True
+            self._buffer = self._buffer[match.end():]
+        if len(self._buffer) >= self.batch_bytes:
+            self._decode_records()
+
+    def close(self):
+        """
+        Return the inspection_df, or None if the payload is empty
+
+        raises:
+            - KeyError/IndexError/TypeError if the payload has no plots record
+            - ValueError if the payload is not valid json
+        """
+        if not self._in_data:
+            # no records array, let json report what the payload is (fetch
+            # imports this module, so import it here)
+            from ..inspection_analysis.fetch import inspection_df_from_payload
+            return inspection_df_from_payload(json.loads(self._buffer or b'null'))
+
+        self._decode_records()
+        if not self._done:
+            raise ValueError('binned_plot_data payload ended inside the data array')
+
+        if not self._batches:
+            return pd.DataFrame()
+        inspection_df = pd.concat(self._batches, ignore_index=True)
+        self._batches = []
+        return inspection_df
+
+    def _data_end(self, buffer):
+        # the data array ends at the first ] after a record (or right away)
+        # that is not in a string
+        end = buffer.find(b']')
+        while end >= 0:
+            if buffer[:end].rstrip()[-1:] in (b'}', b'') and _outside_string(buffer, end):
+                return end
+            end = buffer.find(b']', end + 1)
+        return None
+
+    def _decode_records(self):
+        buffer = self._buffer.lstrip(b' \t\r\n,')
+        end = self._data_end(buffer)
+        if end is not None:
+            # the data array is complete, ignore the rest of the payload
+            records = buffer[:end].rstrip()
+            self._done = True
+            self._buffer = b''
+        else:
+            # complete records end at the last closing brace outside strings
+            cut = buffer.rfind(b'}')
+            while cut >= 0 and not _outside_string(buffer, cut):
+                cut = buffer.rfind(b'}', 0, cut)
+            records, self._buffer = buffer[:cut + 1], buffer[cut + 1:]
+        if records:
+            self._batches.append(self._decode_batch(records))
+
+    def _decode_batch(self, records):
+        if b'\n' in records or b'\r' in records:
+            # pretty printed, records back on one line each
+            records = _LINE_BREAK.sub(b'', records)
+        if b'\\' in records:
+            # escapes in strings, only json decodes them
+            return self._decode_json(records)
+
+        first = records[:_first_brace(records) + 1]
+        if self._columns is None:
+            # key order and string columns of the first record
+            self._keys = _KEY.findall(first)
+            self._columns = {
+                name: str if isinstance(value, str) else self.dtypes.get(name)
+                for name, value in json.loads(first).items()
+            }
+
+        # flat records with every key once, in the same order, and no braces
+        # or commas in strings become csv lines for the C parser
+        count = records.count(b'{')
+        tokens = [b'"' + key + b'":' for key in self._keys]
+        if (
+            len(self._keys) == len(self._columns)
+            and _KEY.findall(first) == self._keys
+            and records.count(b'}') == count
+            and records.count(b',') == count*len(self._keys) - 1
+            and all(records.count(token) == count for token in tokens)
+        ):
+            lines = records[1:-1].replace(b'}, {', b'},{').replace(b'},{', b'\n')
+            for token in tokens:
+                lines = lines.replace(token, b'')
+            try:
+                # strings are read with their quotes, so "" and "null" are
+                # told apart from null
+                batch = pd.read_csv(
+                    io.BytesIO(lines),
+                    header=None,
+                    names=list(self._columns),
+                    dtype={name: dtype for name, dtype in self._columns.items() if dtype is not None},
+                    quoting=csv.QUOTE_NONE,
+                    keep_default_na=False,
+                    na_values={name: ['null'] for name in self._columns},
+                    skipinitialspace=True,
+                )
+            except ValueError:
+                # nulls in an integer column, bad types, ...
+                batch = None
+            if batch is not None and self._strip_quotes(batch):
+                return batch
+
+        return self._decode_json(records)
+
+    def _strip_quotes(self, batch):
+        # unquote the string columns in place, False if any column has a
+        # value of another type than its first record
+        for name, dtype in self._columns.items():
+            column = batch[name]
+            if dtype is str:
+                quoted = column.str.startswith('"') & column.str.endswith('"') & (column.str.len() >= 2)
+                if not quoted[column.notna()].all():
+                    return False
+                batch[name] = column.str[1:-1]
+            elif dtype is None and not pd.api.types.is_numeric_dtype(column):
+                return False
+        return True
+
+    def _decode_json(self, records):
+        batch = pd.DataFrame(json.loads(b'[' + records + b']'))
+        for name, dtype in self.dtypes.items():
+            if name in batch:
+                try:
+                    batch[name] = batch[name].astype(dtype)
+                except (TypeError, ValueError):
+                    # nulls in an integer column, keep them as NaN
+                    batch[name] = pd.to_numeric(batch[name], errors='coerce')
+        return batch
+
+
+# inspection df from a streamed binned plot data response
+def inspection_df_from_response(req, chunk_size=1 << 20, dtypes=BINNED_PLOT_DTYPES):
+    """
+    Take a binned_plot_data response (ideally requested with stream=True) and
+    decode its body incrementally into the inspection_df, or None if the
+    payload is empty
+    """
+    decoder = BinnedPlotDecoder(dtypes)
+    for chunk in req.iter_content(chunk_size):
+        decoder.feed(chunk)
+    return decoder.close()
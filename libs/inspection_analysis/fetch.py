@@ -0,0 +1,195 @@
+import concurrent.futures
+import threading
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..inspection_analysis.decode import inspection_df_from_response
+from ..inspection_analysis.tokens import token
+
+
+# production url components for portal-service deliverables
+prod = {
+    "url_start": "https://portal-service.cloud.geckorobotics.com/api/v1/deliverables/",
+    "url_end": "/binned_plot_data.json",
+    "token": token
+}
+
+# headers
+headers = {
+    "accept": "application/json",
+    "Authorization": f"Bearer {prod['token']}"
+}
+
+# (connect, read) timeouts in seconds; big inspections take a while to send
+DEFAULT_TIMEOUT = (10, 300)
+
+# concurrent requests, and connections kept open per host
+DEFAULT_MAX_WORKERS = 8
+
+# retry transient failures with exponential backoff (0.5s, 1s, 2s, ...)
+DEFAULT_RETRY = Retry(
+    total=4,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["GET", "POST"]),
+)
+
+
+# pooled session with retries
+def make_session(max_workers=DEFAULT_MAX_WORKERS, retry=DEFAULT_RETRY):
+    """
+    Build a requests session with a connection pool sized for max_workers threads
+
+    inputs:
+        - max_workers - number of threads that will share the session
+        - retry - urllib3 Retry policy for transient errors
+    outputs:
+        - session with the portal-service headers set
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+# shared session for the module level helpers
+def get_session():
+    """
+    Return the session shared by all fetches that do not pass their own
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = make_session()
+    return _session
+
+
+# url of the binned plot data deliverable of an inspection
+def binned_plot_data_url(inspection_slug, url_start=None):
+    """
+    Take an inspection slug and return its binned_plot_data url
+
+    url_start defaults to prod['url_start'] (read at call time so it can be
+    pointed at a local stub server)
+    """
+    if url_start is None:
+        url_start = prod['url_start']
+    return f"{url_start}{inspection_slug}{prod['url_end']}"
+
+
+# raw binned plot data response
+def request_binned_plot_data(inspection_slug, session=None, timeout=DEFAULT_TIMEOUT, url_start=None, etag=None, stream=False):
+    """
+    Take an inspection slug and return the binned_plot_data response
+
+    inputs:
+        - inspection_slug - slug as string
+        - session - requests session, defaults to the shared pooled session
+        - timeout - (connect, read) timeout in seconds
+        - url_start - base url, defaults to prod['url_start']
+        - etag - ETag of a cached copy; the server answers 304 if unchanged
+        - stream - leave the body unread, for inspection_df_from_response
+    outputs:
+        - the response (status 200, or 304 when etag still matches)
+    raises:
+        - requests.HTTPError for error responses (after retries)
+    """
+    session = session or get_session()
+    request_headers = {"If-None-Match": etag} if etag else None
+    req = session.get(binned_plot_data_url(inspection_slug, url_start), headers=request_headers, timeout=timeout, stream=stream)
+    if req.status_code != 304:
+        req.raise_for_status()
+    return req
+
+
+# raw binned plot data payload
+def fetch_binned_plot_data(inspection_slug, session=None, timeout=DEFAULT_TIMEOUT, url_start=None):
+    """
+    Take an inspection slug and return the decoded binned_plot_data json
+    (empty payloads are returned as is)
+    """
+    return request_binned_plot_data(inspection_slug, session, timeout, url_start).json()
+
+
+# inspection df from a binned plot data payload
+def inspection_df_from_payload(payload):
+    """
+    Take a binned_plot_data payload and return the inspection_df, or None if
+    the payload is empty
+
+    raises:
+        - KeyError/IndexError/TypeError if the payload has no plots record
+    """
+    if not payload:
+        return None
+    return pd.DataFrame(payload['plots'][0]['data'])
+
+
+# inspection df from the binned plot data
+def fetch_inspection_df(inspection_slug, session=None, timeout=DEFAULT_TIMEOUT, url_start=None):
+    """
+    Take an inspection slug and return the inspection_df, or None if the
+    portal returned no data
+
+    The response body is decoded as it streams in, into typed columns (see
+    decode.BINNED_PLOT_DTYPES) without building a dict per bin.
+    """
+    with request_binned_plot_data(inspection_slug, session, timeout, url_start, stream=True) as req:
+        return inspection_df_from_response(req)
+
+
+# fetch many slugs concurrently
+def fetch_many(inspection_slugs, fetch=fetch_inspection_df, max_workers=DEFAULT_MAX_WORKERS, **kwargs):
+    """
+    Fetch inspection slugs on a thread pool and yield results as they complete
+
+    At most 2*max_workers requests are in flight or waiting to be consumed, so
+    the caller can analyze results while the next downloads run without the
+    whole fleet piling up in memory.
+
+    inputs:
+        - inspection_slugs - iterable of slugs
+        - fetch - function(slug, session=..., **kwargs) run for each slug
+        - max_workers - concurrent requests
+        - kwargs - passed on to fetch (timeout, url_start, ...)
+    outputs:
+        - generator of (position, slug, result, error) in completion order,
+          where position is the index of the slug in inspection_slugs and
+          error is the exception raised by fetch (result is None then)
+    """
+    if kwargs.get("session") is None:
+        # a session of our own, closed when done
+        with make_session(max_workers) as session:
+            yield from fetch_many(inspection_slugs, fetch, max_workers, **dict(kwargs, session=session))
+        return
+
+    pending = {}
+    slugs = iter(enumerate(inspection_slugs))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit():
+            for position, inspection_slug in slugs:
+                future = pool.submit(fetch, inspection_slug, **kwargs)
+                pending[future] = (position, inspection_slug)
+                if len(pending) >= 2*max_workers:
+                    return
+
+        submit()
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                position, inspection_slug = pending.pop(future)
+                try:
+                    yield position, inspection_slug, future.result(), None
+                except Exception as e:
+                    yield position, inspection_slug, None, e
+            submit()
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+
+# compact dtypes of the binned plot data (bins are downcast to fit)
+BIN_COLUMNS = ['x_bin', 'y_bin']
+FLOAT32_COLUMNS = ['thickness', 'plot_x', 'plot_y', 'customer_y']
+CATEGORY_COLUMNS = ['customer_x']
+
+
+# smallest signed integer dtype holding lo..hi
+def _integer_dtype(lo, hi):
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+# compact inspection df
+def compact_inspection_df(inspection_df, inspection_slug=None):
+    """
+    Take an inspection df and return a compact copy
+
+    inputs:
+        - inspection_df - binned data from inspection (as from get_inspection_df)
+        - inspection_slug - added as a categorical 'slug' column if given
+    outputs:
+        - inspection_df with:
+            - x_bin, y_bin - smallest integer dtype that fits (left as is if
+              they hold NaN)
+            - thickness, plot_x, plot_y, customer_y - float32
+            - customer_x - categorical
+            - slug - categorical with a single category
+
+    The threshold counts of utils match the float64 frame as long as the
+    portal thickness has at most 6 significant digits.
+    """
+    columns = {}
+    for column in inspection_df.columns:
+        values = inspection_df[column]
+        if column in BIN_COLUMNS and pd.api.types.is_integer_dtype(values):
+            lo, hi = (values.min(), values.max()) if len(values) else (0, 0)
+            values = values.astype(_integer_dtype(lo, hi))
+        elif column in FLOAT32_COLUMNS and pd.api.types.is_numeric_dtype(values):
+            values = values.astype(np.float32)
+        elif column in CATEGORY_COLUMNS:
+            values = values.astype('category')
+        columns[column] = values
+    compact_df = pd.DataFrame(columns)
+
+    if inspection_slug is not None:
+        compact_df['slug'] = pd.Categorical.from_codes(
+            np.zeros(len(compact_df), dtype=np.int8), categories=[inspection_slug]
+        )
+    return compact_df
+
+
+# categories of all frames, and each frame's codes mapped onto them
+def _union_codes(categoricals):
+    categories = {}
+    for categorical in categoricals:
+        for category in categorical.categories:
+            categories.setdefault(category, len(categories))
+    code_maps = [
+        np.array([categories[category] for category in categorical.categories] + [-1], dtype=np.int64)
+        for categorical in categoricals
+    ]
+    return list(categories), code_maps
+
+
+# fleet frame of many inspections
+def concat_inspections(inspection_dfs):
+    """
+    Concatenate compact inspection dfs into one fleet frame
+
+    Every output column is allocated once and each inspection is written into
+    its slice, so there is no intermediate frame and no object column. The
+    categorical columns (customer_x, slug) are merged by remapping codes.
+
+    inputs:
+        - inspection_dfs - list of compact inspection dfs (compact_inspection_df
+          with a slug) sharing the same columns
+    outputs:
+        - fleet_df - all bins, in order, with a RangeIndex
+    """
+    inspection_dfs = list(inspection_dfs)
+    if not inspection_dfs:
+        return pd.DataFrame()
+
+    lengths = [len(inspection_df) for inspection_df in inspection_dfs]
+    starts = np.concatenate([[0], np.cumsum(lengths)])
+    total = int(starts[-1])
+
+    columns = {}
+    for column in inspection_dfs[0].columns:
+        series = [inspection_df[column] for inspection_df in inspection_dfs]
+
+        if all(isinstance(values.dtype, pd.CategoricalDtype) for values in series):
+            categories, code_maps = _union_codes([values.cat for values in series])
+            codes = np.empty(total, dtype=_integer_dtype(-1, len(categories)))
+            for values, code_map, start, stop in zip(series, code_maps, starts[:-1], starts[1:]):
+                codes[start:stop] = code_map[values.cat.codes.to_numpy()]
+            columns[column] = pd.Categorical.from_codes(codes, categories=categories)
+            continue
+
+        dtypes = [values.dtype for values in series]
+        if all(isinstance(dtype, np.dtype) for dtype in dtypes):
+            out = np.empty(total, dtype=np.result_type(*dtypes))
+            for values, start, stop in zip(series, starts[:-1], starts[1:]):
+                out[start:stop] = values.to_numpy()
+            columns[column] = out
+        else:
+            # extension (ie string) columns
+            columns[column] = pd.concat(series, ignore_index=True)
+
+    return pd.DataFrame(columns, copy=False)
+
+
+# inspections of a fleet frame
+def fleet_inspections(fleet_df):
+    """
+    Yield (slug, inspection_df) for every inspection of a fleet frame, in
+    order, as views of the fleet columns where possible
+    """
+    codes = fleet_df['slug'].cat.codes.to_numpy()
+    if len(codes) == 0:
+        return
+    # inspections are contiguous runs of one slug code
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(codes)) + 1, [len(codes)]])
+    categories = fleet_df['slug'].cat.categories
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        yield categories[codes[start]], fleet_df.iloc[start:stop]
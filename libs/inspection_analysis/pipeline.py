@@ -0,0 +1,305 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+from ..inspection_analysis.cache import get_default_cache
+from ..inspection_analysis.fetch import DEFAULT_MAX_WORKERS, fetch_many
+from ..inspection_analysis.sketch import ThicknessSketch
+from ..inspection_analysis.spatial import find_patches
+from ..inspection_analysis.utils import CRITS_PER10K_LOSS, LOSS_BINS, count_below_sorted, loss_bin_label, tube_minima
+from ..reference.constants import NOMINAL_OVERRIDES
+
+
+class InspectionContext:
+    """
+    One fetched inspection, shared by all metric stages
+
+    The expensive intermediates (sorted thickness, per tube minima) are
+    computed on first use and reused by every later stage, so adding a stage
+    does not add a pass over the bins.
+    """
+
+    def __init__(self, inspection_slug, nominal, inspection_df):
+        self.slug = inspection_slug
+        self.nominal = nominal
+        self.inspection_df = inspection_df
+
+    @functools.cached_property
+    def tube_minima(self):
+        return tube_minima(self.inspection_df)
+
+    @functools.cached_property
+    def sorted_tube_minima(self):
+        return np.sort(self.tube_minima.to_numpy())
+
+    @functools.cached_property
+    def sorted_thickness(self):
+        return np.sort(self.inspection_df.thickness.to_numpy())
+
+    def count_below(self, targets):
+        """
+        Return (tube_counts, bin_counts) below each target thickness
+        """
+        tube_counts = count_below_sorted(self.sorted_tube_minima, targets)
+        bin_counts = count_below_sorted(self.sorted_thickness, targets)
+        return tube_counts, bin_counts
+
+
+class MetricStage:
+    """
+    A metric computed for every inspection of a pipeline run
+
+    Subclasses set columns and implement __call__(context) returning one
+    value per column. A plain function can be wrapped as
+    MetricStage(columns, func).
+    """
+
+    columns = []
+
+    def __init__(self, columns=None, func=None):
+        if columns is not None:
+            self.columns = list(columns)
+        self.func = func
+
+    def __call__(self, context):
+        return self.func(context)
+
+
+class SummaryStage(MetricStage):
+    """
+    min_t, max_t, tubes_inspected and bins_collected
+    """
+
+    columns = ['min_t', 'max_t', 'tubes_inspected', 'bins_collected']
+
+    def __call__(self, context):
+        inspection_df = context.inspection_df
+        return [
+            inspection_df.thickness.min(),
+            inspection_df.thickness.max(),
+            inspection_df.customer_x.nunique(),
+            inspection_df.shape[0],
+        ]
+
+
+class ThresholdStage(MetricStage):
+    """
+    Tubes and bins below nominal*threshold (ie 40% loss => threshold = .6)
+    """
+
+    def __init__(self, threshold, columns=('critical_tubes', 'critical_bins')):
+        super().__init__(columns)
+        self.threshold = threshold
+
+    def __call__(self, context):
+        tube_counts, bin_counts = context.count_below([context.nominal*self.threshold])
+        return [int(tube_counts[0]), int(bin_counts[0])]
+
+
+class LossHistogramStage(MetricStage):
+    """
+    crits_per10k plus tubes and bins below each loss bin of a loss grid
+    """
+
+    def __init__(self, loss_bins=LOSS_BINS):
+        self.loss_bins = list(loss_bins)
+        super().__init__(
+            ['crits_per10k']
+            + ['Tubes w ' + loss_bin_label(bini) for bini in self.loss_bins]
+            + ['Bins w ' + loss_bin_label(bini) for bini in self.loss_bins]
+        )
+
+    def __call__(self, context):
+        # crits_per10k comes from the same pass, add its bin if the grid lacks it
+        hist_bins = list(self.loss_bins)
+        if CRITS_PER10K_LOSS not in hist_bins:
+            hist_bins.append(CRITS_PER10K_LOSS)
+        targets = [context.nominal*(1-bini) for bini in hist_bins]
+        tube_counts, bin_counts = context.count_below(targets)
+
+        # add 40%loss per 10k bins stat:
+        bins_collected = context.inspection_df.shape[0]
+        crits_per10k = round((bin_counts[hist_bins.index(CRITS_PER10K_LOSS)]/bins_collected)*10000)
+
+        n = len(self.loss_bins)
+        return [crits_per10k] + tube_counts[:n].tolist() + bin_counts[:n].tolist()
+
+
+class TubeMinimaStage(MetricStage):
+    """
+    Series of the min thickness per customer_x, in one object column
+    """
+
+    columns = ['tube_minima']
+
+    def __call__(self, context):
+        return [context.tube_minima]
+
+
+class SketchStage(MetricStage):
+    """
+    ThicknessSketch of the inspection, serialized for the results table (see
+    sketch.check_sketches to redo threshold studies from it)
+    """
+
+    columns = ['sketch']
+
+    def __init__(self, resolution=None):
+        super().__init__()
+        self.resolution = resolution
+
+    def __call__(self, context):
+        sketch = ThicknessSketch.from_sorted(
+            context.sorted_thickness,
+            context.sorted_tube_minima,
+            context.inspection_df.customer_x.nunique(),
+            context.inspection_df.shape[0],
+            self.resolution,
+        )
+        return [sketch.to_bytes()]
+
+
+class PatchStage(MetricStage):
+    """
+    Corrosion patches below nominal*threshold (see spatial.find_patches): the
+    number of patches and the size, tubes and min thickness of the largest
+    """
+
+    columns = ['patches', 'largest_patch_bins', 'largest_patch_tubes', 'largest_patch_min_t']
+
+    def __init__(self, threshold, connectivity=8):
+        super().__init__()
+        self.threshold = threshold
+        self.connectivity = connectivity
+
+    def __call__(self, context):
+        patch_df, _ = find_patches(context.inspection_df, context.nominal*self.threshold, self.connectivity)
+        if patch_df.empty:
+            return [0, 0, 0, np.nan]
+        largest = patch_df.iloc[0]
+        return [len(patch_df), largest.bins, largest.tubes, largest.min_t]
+
+
+# result columns of a list of stages
+def pipeline_columns(stages):
+    return ['slug', 'nominal'] + [column for stage in stages for column in stage.columns]
+
+
+# resolve slugs and nominals of the targets
+def resolve_targets(targets_df, nominal_overrides=NOMINAL_OVERRIDES):
+    """
+    Return the slugs of targets_df and their nominals, with nominal_overrides
+    applied
+    """
+    inspection_slugs = targets_df['slug'].tolist()
+    nominals = [
+        nominal_overrides.get(inspection_slug, nominal)
+        for inspection_slug, nominal in zip(inspection_slugs, targets_df['nominal'].tolist())
+    ]
+    return inspection_slugs, nominals
+
+
+# apply every metric stage to one inspection
+def apply_stages(inspection_slug, nominal, inspection_df, stages):
+    """
+    Return the values of all stages (in column order) for one inspection
+
+    raises:
+        - ValueError if a stage returns the wrong number of values
+        - whatever a stage raises
+    """
+    context = InspectionContext(inspection_slug, nominal, inspection_df)
+    data = []
+    for stage in stages:
+        values = list(stage(context))
+        if len(values) != len(stage.columns):
+            raise ValueError(f'{type(stage).__name__} returned {len(values)} values for {len(stage.columns)} columns')
+        data += values
+    return data
+
+
+# fetch and analyze, one result at a time
+def iter_pipeline(targets_df, stages, nominal_overrides=NOMINAL_OVERRIDES, max_workers=DEFAULT_MAX_WORKERS, cache=None):
+    """
+    Fetch each target inspection and apply all metric stages, yielding the
+    results as they complete (see run_pipeline)
+
+    outputs:
+        - generator of (row, slug, nominal, kind, values, error) where row is
+          the position in targets_df, kind is 'ok', 'no_data' or 'error',
+          values the stage values ('ok' only) and error the repr of the
+          exception ('error' only)
+    """
+    cache = cache or get_default_cache()
+
+    # resolve slugs and nominals up front so downloads can start right away
+    inspection_slugs, nominals = resolve_targets(targets_df, nominal_overrides)
+
+    # fetch concurrently, analyze each inspection as soon as it arrives
+    fetched = fetch_many(inspection_slugs, fetch=cache.get, max_workers=max_workers)
+    for count, (row, inspection_slug, inspection_df, error) in enumerate(fetched):
+        # print every tenth row num as a progress tracker
+        if count%10 == 0:
+            print('{}/{}'.format(count, len(inspection_slugs)))
+
+        nominal = nominals[row]
+        if error is None and inspection_df is None:
+            print('Inspection slug failed to return data: {}'.format(inspection_slug))
+            yield row, inspection_slug, nominal, 'no_data', None, None
+            continue
+        try:
+            if error is not None:
+                raise error
+            values = apply_stages(inspection_slug, nominal, inspection_df, stages)
+        except Exception as e:
+            print('Error: {} {!r}'.format(inspection_slug, e))
+            yield row, inspection_slug, nominal, 'error', None, repr(e)
+            continue
+        yield row, inspection_slug, nominal, 'ok', values, None
+
+
+# collect pipeline results into the output frames
+def collect_results(results, stages):
+    """
+    Take (row, slug, nominal, kind, values, error) results in any order and
+    return data_df and error_df in row order (see run_pipeline)
+    """
+    rows = {}
+    error_rows = {}
+    for row, inspection_slug, nominal, kind, values, error in results:
+        if kind == 'ok':
+            rows[row] = [inspection_slug, nominal] + list(values)
+        else:
+            error_rows[row] = [inspection_slug, nominal, kind, error]
+
+    # keep the order of targets_df
+    data_df = pd.DataFrame([rows[row] for row in sorted(rows)], columns=pipeline_columns(stages))
+    error_df = pd.DataFrame([error_rows[row] for row in sorted(error_rows)], columns=['slug', 'nominal', 'kind', 'error'])
+
+    return data_df, error_df
+
+
+# fetch once, apply every metric stage
+def run_pipeline(targets_df, stages, nominal_overrides=NOMINAL_OVERRIDES, max_workers=DEFAULT_MAX_WORKERS, cache=None):
+    """
+    Fetch and parse each target inspection once and apply all metric stages
+
+    inputs:
+        - targets_df - contains slug and nominal headers
+        - stages - list of MetricStage, their columns are concatenated in order
+        - nominal_overrides - slug -> nominal for inspections with bad portal
+          nominals (default: reference.constants.NOMINAL_OVERRIDES)
+        - max_workers - number of inspections downloaded concurrently
+        - cache - InspectionCache to read through, defaults to the shared cache
+    outputs:
+        - data_df - one row per inspection, in targets_df order, with columns
+          'slug', 'nominal' and the columns of each stage
+        - error_df - one row per inspection without results, in targets_df
+          order, with columns:
+            - 'slug'
+            - 'nominal'
+            - 'kind' - 'no_data' if the portal returned nothing, else 'error'
+            - 'error' - repr of the exception
+    """
+    return collect_results(iter_pipeline(targets_df, stages, nominal_overrides, max_workers, cache), stages)
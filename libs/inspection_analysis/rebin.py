@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+
+
+# default pyramid, each level a 2x2 block of the previous one
+PYRAMID_LEVELS = [(2, 2), (4, 4), (8, 8), (16, 16), (32, 32), (64, 64)]
+
+
+# block statistics of cells
+def _reduce_blocks(block_x, block_y, mins, maxs, sums, counts):
+    """
+    Merge cells into blocks: (block_x, block_y, min, max, sum, count) of each
+    non empty block, sorted by block_y then block_x
+    """
+    width = int(block_x.max()) + 1 if len(block_x) else 1
+    ids = block_y.astype(np.int64)*width + block_x
+    order = np.argsort(ids, kind='stable')
+    ids = ids[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(ids)) + 1]) if len(ids) else np.zeros(0, dtype=np.int64)
+
+    block_ids = ids[starts]
+    return (
+        block_ids % width,
+        block_ids//width,
+        np.fmin.reduceat(mins[order], starts) if len(ids) else mins,
+        np.fmax.reduceat(maxs[order], starts) if len(ids) else maxs,
+        np.add.reduceat(sums[order], starts) if len(ids) else sums,
+        np.add.reduceat(counts[order], starts) if len(ids) else counts,
+    )
+
+
+# block statistics to a df
+def _blocks_df(x0, y0, x_factor, y_factor, blocks):
+    block_x, block_y, mins, maxs, sums, counts = blocks
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums/counts
+    return pd.DataFrame({
+        'block_x': block_x,
+        'block_y': block_y,
+        'x_bin_start': x0 + block_x*x_factor,
+        'y_bin_start': y0 + block_y*y_factor,
+        'bins': counts,
+        'min_t': mins,
+        'mean_t': means,
+        'max_t': maxs,
+    })
+
+
+# thickness of an inspection as level 0 cells
+def _bins(inspection_df):
+    x_bins = inspection_df.x_bin.to_numpy().astype(np.int64)
+    y_bins = inspection_df.y_bin.to_numpy().astype(np.int64)
+    thickness = inspection_df.thickness.to_numpy().astype(np.float64)
+    valid = ~np.isnan(thickness)
+    x0 = int(x_bins.min()) if len(x_bins) else 0
+    y0 = int(y_bins.min()) if len(y_bins) else 0
+    sums = np.where(valid, thickness, 0.0)
+    return x0, y0, x_bins - x0, y_bins - y0, thickness, sums, valid.astype(np.int64)
+
+
+# coarser block statistics of an inspection
+def rebin(inspection_df, x_factor=1, y_factor=1):
+    """
+    Take an inspection df and return thickness statistics of blocks of
+    x_factor by y_factor bins (ie x_factor=1 for per tube elevation bands)
+
+    inputs:
+        - inspection_df - binned data from inspection
+        - x_factor, y_factor - block size in bins
+    outputs:
+        - block_df - one row per block with bins, with columns:
+            - 'block_x', 'block_y' - block position
+            - 'x_bin_start', 'y_bin_start' - first bin of the block
+            - 'bins' - bins with a thickness reading
+            - 'min_t', 'mean_t', 'max_t' - thickness statistics (NaN if the
+              block only has bins without a reading)
+    """
+    x0, y0, x_bins, y_bins, thickness, sums, counts = _bins(inspection_df)
+    blocks = _reduce_blocks(x_bins//x_factor, y_bins//y_factor, thickness, thickness, sums, counts)
+    return _blocks_df(x0, y0, x_factor, y_factor, blocks)
+
+
+class ThicknessPyramid:
+    """
+    Precomputed block statistics of an inspection at several resolutions
+
+    Each level is reduced from the finest level it is a multiple of, so the
+    full resolution bins are scanned once. Zoomed out summaries and plots
+    then read a level (level, grid) instead of the bins.
+
+    inputs:
+        - inspection_df - binned data from inspection
+        - levels - list of (x_factor, y_factor) block sizes, default
+          PYRAMID_LEVELS
+    """
+
+    def __init__(self, inspection_df, levels=PYRAMID_LEVELS):
+        self.x0, self.y0, x_bins, y_bins, thickness, sums, counts = _bins(inspection_df)
+        # the full resolution (one bin per cell) level
+        self._levels = {(1, 1): _reduce_blocks(x_bins, y_bins, thickness, thickness, sums, counts)}
+
+        for x_factor, y_factor in sorted(levels, key=lambda level: level[0]*level[1]):
+            # finest computed level this one is made of
+            source = max(
+                (level for level in self._levels if x_factor % level[0] == 0 and y_factor % level[1] == 0),
+                key=lambda level: level[0]*level[1],
+            )
+            block_x, block_y, mins, maxs, level_sums, level_counts = self._levels[source]
+            self._levels[(x_factor, y_factor)] = _reduce_blocks(
+                block_x//(x_factor//source[0]),
+                block_y//(y_factor//source[1]),
+                mins, maxs, level_sums, level_counts,
+            )
+
+    @property
+    def levels(self):
+        return sorted(self._levels, key=lambda level: level[0]*level[1])
+
+    def level(self, x_factor, y_factor):
+        """
+        Return the block_df of a level (see rebin)
+        """
+        return _blocks_df(self.x0, self.y0, x_factor, y_factor, self._levels[(x_factor, y_factor)])
+
+    def grid(self, x_factor, y_factor, stat='min_t'):
+        """
+        Return a level as a dense (block_y, block_x) array of a statistic
+        ('min_t', 'mean_t', 'max_t' or 'bins'), NaN for empty blocks
+        """
+        block_x, block_y, mins, maxs, sums, counts = self._levels[(x_factor, y_factor)]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = {'min_t': mins, 'mean_t': sums/counts, 'max_t': maxs, 'bins': counts}[stat]
+        shape = (int(block_y.max()) + 1, int(block_x.max()) + 1) if len(block_x) else (0, 0)
+        grid = np.full(shape, np.nan)
+        grid[block_y, block_x] = values
+        return grid
+
+    def best_level(self, max_blocks):
+        """
+        Return the finest (x_factor, y_factor) level with at most max_blocks
+        blocks, ie for a plot of limited resolution
+        """
+        for level in self.levels:
+            if len(self._levels[level][0]) <= max_blocks:
+                return level
+        return self.levels[-1]
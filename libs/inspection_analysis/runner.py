@@ -0,0 +1,209 @@
+import base64
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ..inspection_analysis.fetch import DEFAULT_MAX_WORKERS
+from ..inspection_analysis.pipeline import iter_pipeline, pipeline_columns
+from ..reference.constants import NOMINAL_OVERRIDES
+
+
+# json for numpy scalars and bytes (ie serialized sketches)
+def _default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode()}
+    raise TypeError(f'{type(value).__name__} values can not be stored, use a stage returning plain values')
+
+
+def _object_hook(value):
+    if '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+# stage types and parameters, to tell stores of different stages apart
+def stage_fingerprint(stages):
+    """
+    Return a json-able description of stages: class and parameters (ie
+    threshold) of each, functions by name
+    """
+    def describe(value):
+        if callable(value):
+            return getattr(value, '__qualname__', repr(value))
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, (np.ndarray, tuple)):
+            return [describe(item) for item in list(value)]
+        if isinstance(value, list):
+            return [describe(item) for item in value]
+        if isinstance(value, dict):
+            return {str(key): describe(item) for key, item in value.items()}
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        return repr(value)
+
+    return [
+        # names without modules, they depend on how libs was imported
+        [type(stage).__qualname__, describe(dict(sorted(vars(stage).items())))]
+        for stage in stages
+    ]
+
+
+class ResultStore:
+    """
+    Append-only local store of per slug pipeline results
+
+    A directory with meta.json (the result columns) and records.jsonl, one
+    json record per processed slug:
+        {slug, nominal, kind, values, error, recorded_at}
+    Records are flushed as they are written, so a crash loses at most the
+    record being written (a truncated last line is ignored on read). The
+    latest record of a slug wins.
+
+    inputs:
+        - path - store directory
+        - columns - result columns (pipeline_columns of the stages); must
+          match an existing store
+        - fingerprint - stage_fingerprint of the stages; must match an
+          existing store, so results of other parameters (ie another
+          threshold with the same columns) are never reused
+    """
+
+    def __init__(self, path, columns, fingerprint=None):
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.fingerprint = fingerprint
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        meta_path = self.path / 'meta.json'
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            if meta['columns'] != self.columns:
+                raise ValueError(f'{self.path} holds results for columns {meta["columns"]}, not {self.columns}')
+            if meta.get('stages') != self.fingerprint:
+                raise ValueError(f'{self.path} holds results of stages {meta.get("stages")}, not {self.fingerprint}')
+        else:
+            meta_path.write_text(json.dumps({'columns': self.columns, 'stages': self.fingerprint}))
+        self.records_path = self.path / 'records.jsonl'
+        self._line_start = False
+
+    def records(self):
+        """
+        Return slug -> latest record, in order of first record
+        """
+        records = {}
+        if not self.records_path.exists():
+            return records
+        with open(self.records_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line, object_hook=_object_hook)
+                except ValueError:
+                    # truncated by a crash
+                    continue
+                records[record['slug']] = record
+        return records
+
+    def append(self, inspection_slug, nominal, kind, values=None, error=None):
+        record = {
+            'slug': inspection_slug,
+            'nominal': nominal,
+            'kind': kind,
+            'values': values,
+            'error': error,
+            'recorded_at': time.time(),
+        }
+        line = json.dumps(record, default=_default)
+        if not self._line_start:
+            # a crash may have left a truncated last line, start a new one
+            try:
+                with open(self.records_path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        line = '\n' + line
+            except OSError:
+                # missing or empty file
+                pass
+            self._line_start = True
+        with open(self.records_path, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def to_frames(self, inspection_slugs=None):
+        """
+        Return data_df and error_df (as run_pipeline) of the latest records,
+        in the order of inspection_slugs if given (slugs without a record are
+        left out), else in record order
+        """
+        records = self.records()
+        if inspection_slugs is not None:
+            records = {inspection_slug: records[inspection_slug] for inspection_slug in dict.fromkeys(inspection_slugs) if inspection_slug in records}
+
+        data_list = []
+        error_list = []
+        for record in records.values():
+            if record['kind'] == 'ok':
+                data_list.append([record['slug'], record['nominal']] + record['values'])
+            else:
+                error_list.append([record['slug'], record['nominal'], record['kind'], record['error']])
+
+        data_df = pd.DataFrame(data_list, columns=self.columns)
+        error_df = pd.DataFrame(error_list, columns=['slug', 'nominal', 'kind', 'error'])
+        return data_df, error_df
+
+
+# slugs to (re)process
+def pending_targets(targets_df, store, nominal_overrides=NOMINAL_OVERRIDES, retry_failed=True):
+    """
+    Return the rows of targets_df without an up to date record: never
+    recorded, recorded with another nominal, or (with retry_failed) recorded
+    as an error or without data
+    """
+    records = store.records()
+    pending = []
+    for inspection_slug, nominal in zip(targets_df['slug'], targets_df['nominal']):
+        nominal = nominal_overrides.get(inspection_slug, nominal)
+        record = records.get(inspection_slug)
+        pending.append(
+            record is None
+            or record['nominal'] != nominal
+            or (retry_failed and record['kind'] != 'ok')
+        )
+    return targets_df[np.array(pending, dtype=bool)].reset_index(drop=True)
+
+
+# resumable pipeline run
+def run_checkpointed(targets_df, stages, store_path, refresh=False, retry_failed=True, nominal_overrides=NOMINAL_OVERRIDES, max_workers=DEFAULT_MAX_WORKERS, cache=None):
+    """
+    run_pipeline that records every slug in a ResultStore as it completes
+
+    Re-running with the same store resumes: only slugs without an up to date
+    record are processed (see pending_targets), so a crashed run picks up
+    where it stopped and a nightly refresh only costs the new inspections.
+
+    inputs:
+        - targets_df, stages, nominal_overrides, max_workers, cache - as for
+          run_pipeline
+        - store_path - ResultStore directory (one per stage list and
+          parameters, a store of other stages raises ValueError)
+        - refresh - process every slug again
+        - retry_failed - process slugs recorded as errors or without data again
+    outputs:
+        - data_df, error_df - as run_pipeline, for all of targets_df (from the
+          store)
+    """
+    store = ResultStore(store_path, pipeline_columns(stages), stage_fingerprint(stages))
+    pending_df = targets_df.reset_index(drop=True) if refresh else pending_targets(targets_df, store, nominal_overrides, retry_failed)
+    print('{} of {} slugs to process'.format(len(pending_df), len(targets_df)))
+
+    for _, inspection_slug, nominal, kind, values, error in iter_pipeline(pending_df, stages, nominal_overrides, max_workers, cache):
+        store.append(inspection_slug, nominal, kind, values, error)
+
+    return store.to_frames(targets_df['slug'].tolist())
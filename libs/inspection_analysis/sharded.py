@@ -0,0 +1,181 @@
+import concurrent.futures
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from ..inspection_analysis.cache import get_default_cache
+from ..inspection_analysis.fetch import DEFAULT_MAX_WORKERS, fetch_many
+from ..inspection_analysis.pipeline import apply_stages, collect_results, resolve_targets
+from ..reference.constants import NOMINAL_OVERRIDES
+
+
+# workers are started from a clean server process (or spawned), never
+# forked from this one: the fetch threads and pooled sessions would be
+# copied mid-flight and can deadlock the children
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class SharedInspection:
+    """
+    An inspection df packed into one shared memory block
+
+    Numeric columns are copied into the block once and mapped back without a
+    copy in the worker; other columns (ie customer_x) travel as integer codes
+    in the block plus their (small) list of categories. Only the descriptor
+    is pickled.
+    """
+
+    def __init__(self, inspection_df):
+        columns = []
+        arrays = []
+        offset = 0
+        for column in inspection_df.columns:
+            values = inspection_df[column]
+            if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biuf':
+                array = values.to_numpy()
+                categories = None
+            else:
+                codes, uniques = pd.factorize(values, use_na_sentinel=True)
+                array = codes.astype(np.int32)
+                categories = (list(uniques), values.dtype)
+            # 8 byte aligned columns
+            offset = -(-offset//8)*8
+            columns.append((column, array.dtype.str, offset, len(array), categories))
+            arrays.append((offset, array))
+            offset += array.nbytes
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for offset, array in arrays:
+            np.ndarray(array.shape, array.dtype, self.shm.buf, offset)[:] = array
+        self.descriptor = (self.shm.name, columns)
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# rebuild an inspection df from a SharedInspection descriptor
+def _attach(descriptor):
+    name, columns = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    data = {}
+    for column, dtype, offset, length, categories in columns:
+        array = np.ndarray((length,), np.dtype(dtype), shm.buf, offset)
+        if categories is None:
+            data[column] = array
+        else:
+            uniques, original_dtype = categories
+            data[column] = pd.Series(pd.Categorical.from_codes(array, uniques)).astype(original_dtype)
+    return shm, pd.DataFrame(data, copy=False)
+
+
+# process pool task
+def _analyze_shared(descriptor, inspection_slug, nominal, stages):
+    shm, inspection_df = _attach(descriptor)
+    try:
+        return 'ok', apply_stages(inspection_slug, nominal, inspection_df, stages), None
+    except Exception as e:
+        return 'error', None, repr(e)
+    finally:
+        del inspection_df
+        try:
+            shm.close()
+        except BufferError:
+            # a stage kept a view of the block, it is unmapped once collected
+            pass
+
+
+# fetch with threads, analyze with processes
+def iter_sharded(targets_df, stages, processes=None, nominal_overrides=NOMINAL_OVERRIDES, max_workers=DEFAULT_MAX_WORKERS, cache=None):
+    """
+    iter_pipeline with the stages applied on a process pool
+
+    Inspections are fetched on threads as in iter_pipeline, packed into
+    shared memory and analyzed in worker processes. At most 2*processes
+    inspections are held in shared memory at once.
+
+    inputs:
+        - as iter_pipeline, plus processes - worker processes (default: cpu
+          count); stages must be picklable and importable (no lambdas
+          or classes defined in a notebook)
+    outputs:
+        - generator of (row, slug, nominal, kind, values, error) as
+          iter_pipeline, in completion order
+    """
+    cache = cache or get_default_cache()
+    inspection_slugs, nominals = resolve_targets(targets_df, nominal_overrides)
+
+    processes = processes or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(START_METHOD)) as pool:
+        max_pending = 2*processes
+        pending = {}
+
+        def completed(return_when):
+            done, _ = concurrent.futures.wait(pending, return_when=return_when)
+            for future in done:
+                row, inspection_slug, nominal, shared = pending.pop(future)
+                shared.release()
+                try:
+                    kind, values, error = future.result()
+                except Exception as e:
+                    # the worker died or the stages could not be pickled
+                    kind, values, error = 'error', None, repr(e)
+                if kind == 'error':
+                    print('Error: {} {}'.format(inspection_slug, error))
+                yield row, inspection_slug, nominal, kind, values, error
+
+        fetched = fetch_many(inspection_slugs, fetch=cache.get, max_workers=max_workers)
+        try:
+            for count, (row, inspection_slug, inspection_df, error) in enumerate(fetched):
+                # print every tenth row num as a progress tracker
+                if count%10 == 0:
+                    print('{}/{}'.format(count, len(inspection_slugs)))
+
+                nominal = nominals[row]
+                if error is None and inspection_df is None:
+                    print('Inspection slug failed to return data: {}'.format(inspection_slug))
+                    yield row, inspection_slug, nominal, 'no_data', None, None
+                    continue
+                if error is not None:
+                    print('Error: {} {!r}'.format(inspection_slug, error))
+                    yield row, inspection_slug, nominal, 'error', None, repr(error)
+                    continue
+
+                shared = SharedInspection(inspection_df)
+                del inspection_df
+                try:
+                    future = pool.submit(_analyze_shared, shared.descriptor, inspection_slug, nominal, stages)
+                except BaseException:
+                    # ie a broken pool, the block is not pending yet
+                    shared.release()
+                    raise
+                pending[future] = (row, inspection_slug, nominal, shared)
+                if len(pending) >= max_pending:
+                    yield from completed(concurrent.futures.FIRST_COMPLETED)
+
+            while pending:
+                yield from completed(concurrent.futures.ALL_COMPLETED)
+        finally:
+            # the consumer stopped early or raised: no block may outlive
+            # the generator
+            fetched.close()
+            for future in pending:
+                future.cancel()
+            concurrent.futures.wait(pending)
+            for _, _, _, shared in pending.values():
+                shared.release()
+            pending.clear()
+
+
+# run_pipeline on a process pool
+def run_sharded(targets_df, stages, processes=None, nominal_overrides=NOMINAL_OVERRIDES, max_workers=DEFAULT_MAX_WORKERS, cache=None):
+    """
+    run_pipeline with the per inspection analysis spread over processes
+
+    outputs:
+        - data_df, error_df - same schema and (targets_df) order as run_pipeline
+    """
+    return collect_results(iter_sharded(targets_df, stages, processes, nominal_overrides, max_workers, cache), stages)
@@ -0,0 +1,190 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from ..inspection_analysis.utils import LOSS_BINS, count_below_sorted, loss_bin_label, tube_minima
+
+
+# float32 thickness back to the decimals it was rounded from (see
+# count_below_sorted), so sketches of any frame merge exactly
+def _as_float64(values):
+    if values.dtype == np.float32:
+        return np.array([float(str(value)) for value in values], dtype=np.float64)
+    return values.astype(np.float64, copy=False)
+
+
+# distinct values and their counts of a sorted array, NaN dropped
+def _value_counts(sorted_values):
+    sorted_values = sorted_values[~np.isnan(sorted_values)]
+    if len(sorted_values) == 0:
+        return sorted_values, np.zeros(0, dtype=np.int64)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_values)) + 1])
+    counts = np.diff(np.concatenate([starts, [len(sorted_values)]]))
+    return sorted_values[starts], counts.astype(np.int64)
+
+
+class ThicknessSketch:
+    """
+    Threshold agnostic summary of the thickness of one or more inspections
+
+    Holds the distinct bin thicknesses with their counts and the sorted min
+    thickness of every tube, so the tubes and bins below any thickness are
+    counted without the raw bins. Portal thickness is quantized, so this is
+    exact and small (a few hundred values); pass a resolution to round
+    unquantized data to a fixed grid instead.
+
+    Sketches of several inspections merge (ThicknessSketch.merge) into the
+    sketch of their union, ie a unit or a customer.
+    """
+
+    def __init__(self, values, counts, tube_minima, tubes_inspected, bins_collected):
+        self.values = values
+        self.counts = counts
+        self.tube_minima = tube_minima
+        self.tubes_inspected = tubes_inspected
+        self.bins_collected = bins_collected
+        self._cumulative = np.concatenate([[0], np.cumsum(counts)])
+
+    @classmethod
+    def from_sorted(cls, sorted_thickness, sorted_tube_minima, tubes_inspected, bins_collected, resolution=None):
+        """
+        Build from sorted thickness and tube minima (NaN last, as np.sort)
+        """
+        if resolution is not None:
+            sorted_thickness = np.round(sorted_thickness/resolution)*resolution
+            sorted_tube_minima = np.round(sorted_tube_minima/resolution)*resolution
+        values, counts = _value_counts(sorted_thickness)
+        minima = sorted_tube_minima[~np.isnan(sorted_tube_minima)]
+        return cls(_as_float64(values), counts, _as_float64(minima), int(tubes_inspected), int(bins_collected))
+
+    @classmethod
+    def from_inspection_df(cls, inspection_df, resolution=None):
+        """
+        Take an inspection df (as for analyze_inspection_df) and return its sketch
+        """
+        return cls.from_sorted(
+            np.sort(inspection_df.thickness.to_numpy()),
+            np.sort(tube_minima(inspection_df).to_numpy()),
+            inspection_df.customer_x.nunique(),
+            inspection_df.shape[0],
+            resolution,
+        )
+
+    @classmethod
+    def merge(cls, sketches):
+        """
+        Sketch of the union of inspections (tubes of different inspections
+        are different tubes)
+        """
+        sketches = list(sketches)
+        values = np.concatenate([sketch.values for sketch in sketches])
+        counts = np.concatenate([sketch.counts for sketch in sketches])
+        values, inverse = np.unique(values, return_inverse=True)
+        return cls(
+            values,
+            np.bincount(inverse, weights=counts, minlength=len(values)).astype(np.int64),
+            np.sort(np.concatenate([sketch.tube_minima for sketch in sketches])),
+            sum(sketch.tubes_inspected for sketch in sketches),
+            sum(sketch.bins_collected for sketch in sketches),
+        )
+
+    @property
+    def min_t(self):
+        return self.values[0] if len(self.values) else np.nan
+
+    @property
+    def max_t(self):
+        return self.values[-1] if len(self.values) else np.nan
+
+    def count_below(self, targets):
+        """
+        Return (tube_counts, bin_counts) below each target thickness
+        """
+        tube_counts = count_below_sorted(self.tube_minima, targets)
+        bin_counts = self._cumulative[count_below_sorted(self.values, targets)]
+        return tube_counts, bin_counts
+
+    def analyze(self, nominal, threshold):
+        """
+        Same outputs as analyze_inspection_df(inspection_df, nominal, threshold)
+        """
+        tube_counts, bin_counts = self.count_below([nominal*threshold])
+        return self.min_t, self.max_t, self.tubes_inspected, self.bins_collected, int(tube_counts[0]), int(bin_counts[0])
+
+    def hist(self, nominal, loss_bins=LOSS_BINS):
+        """
+        Same outputs as hist_inspection_df(inspection_df, nominal, loss_bins)
+        """
+        tube_counts, bin_counts = self.count_below([nominal*(1-bini) for bini in loss_bins])
+        return self.min_t, self.max_t, self.tubes_inspected, self.bins_collected, tube_counts.tolist(), bin_counts.tolist()
+
+    def to_bytes(self):
+        """
+        Serialize, ie to store in a results table column
+        """
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            values=self.values,
+            counts=self.counts,
+            tube_minima=self.tube_minima,
+            totals=np.array([self.tubes_inspected, self.bins_collected], dtype=np.int64),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data)) as arrays:
+            tubes_inspected, bins_collected = arrays['totals'].tolist()
+            return cls(arrays['values'], arrays['counts'], arrays['tube_minima'], tubes_inspected, bins_collected)
+
+
+# sketches of a results table column
+def _sketches(results_df, sketch_column):
+    for sketch in results_df[sketch_column]:
+        yield sketch if isinstance(sketch, ThicknessSketch) else ThicknessSketch.from_bytes(sketch)
+
+
+# check_thickness from stored sketches
+def check_sketches(results_df, threshold, sketch_column='sketch'):
+    """
+    Redo check_thickness for a new threshold from a results table with sketches
+
+    inputs:
+        - results_df - slug, nominal and a column of ThicknessSketch (or their
+          to_bytes), ie from run_pipeline with a SketchStage
+        - threshold - float (example = 0.6)
+    outputs:
+        - data_df - the columns of check_thickness
+    """
+    data_list = [
+        [inspection_slug, nominal] + list(sketch.analyze(nominal, threshold))
+        for inspection_slug, nominal, sketch in zip(results_df['slug'], results_df['nominal'], _sketches(results_df, sketch_column))
+    ]
+    return pd.DataFrame(data_list, columns=['slug', 'nominal', 'min_t', 'max_t', 'tubes_inspected', 'bins_collected', 'critical_tubes', 'critical_bins'])
+
+
+# get_thickness_histogram from stored sketches
+def histogram_sketches(results_df, loss_bins=LOSS_BINS, sketch_column='sketch'):
+    """
+    Redo the loss histogram of get_thickness_histogram (without crits_per10k,
+    which is the 40% Loss bin count) from a results table with sketches
+    """
+    loss_bins = list(loss_bins)
+    data_list = []
+    for inspection_slug, nominal, sketch in zip(results_df['slug'], results_df['nominal'], _sketches(results_df, sketch_column)):
+        min_t, max_t, tubes_inspected, bins_collected, tube_counts, bin_counts = sketch.hist(nominal, loss_bins)
+        data_list.append([inspection_slug, nominal, min_t, max_t, tubes_inspected, bins_collected] + tube_counts + bin_counts)
+    return pd.DataFrame(data_list, columns=[
+        'slug',
+        'nominal',
+        'min_t',
+        'max_t',
+        'tubes_inspected',
+        'bins_collected',
+    ] + [
+        'Tubes w ' + loss_bin_label(bini) for bini in loss_bins
+    ] + [
+        'Bins w ' + loss_bin_label(bini) for bini in loss_bins
+    ])
@@ -0,0 +1,233 @@
+import numpy as np
+import pandas as pd
+
+from ..inspection_analysis.utils import below_target
+
+
+# neighbour offsets (dx, dy) of a cell, one direction per pair
+NEIGHBOURS = {
+    4: [(1, 0), (0, 1)],
+    8: [(1, 0), (0, 1), (1, 1), (1, -1)],
+}
+
+
+class BinGrid:
+    """
+    Dense (y_bin, x_bin) grid of an inspection df
+
+    thickness[y, x] is the min thickness of the bins of cell (x0 + x, y0 + y)
+    (NaN where nothing was collected) and rows[y, x] the position in
+    inspection_df of that bin (-1 if empty), so window queries are array
+    slices.
+
+    inputs:
+        - inspection_df - binned data from inspection (x_bin, y_bin, thickness)
+    """
+
+    def __init__(self, inspection_df):
+        self.inspection_df = inspection_df
+        self.x_bins = inspection_df.x_bin.to_numpy()
+        self.y_bins = inspection_df.y_bin.to_numpy()
+        thickness = inspection_df.thickness.to_numpy()
+
+        if len(inspection_df):
+            self.x0, self.y0 = int(self.x_bins.min()), int(self.y_bins.min())
+            shape = (int(self.y_bins.max()) - self.y0 + 1, int(self.x_bins.max()) - self.x0 + 1)
+        else:
+            self.x0 = self.y0 = 0
+            shape = (0, 0)
+        self.shape = shape
+
+        # fill thickest first so each cell ends up with its min bin
+        order = np.argsort(thickness, kind='stable')[::-1]
+        cells = (self.y_bins[order] - self.y0, self.x_bins[order] - self.x0)
+        self.thickness = np.full(shape, np.nan, dtype=thickness.dtype)
+        self.rows = np.full(shape, -1, dtype=np.int64)
+        self.thickness[cells] = thickness[order]
+        self.rows[cells] = order
+
+        # all bins of each cell, as cell_rows[cell_start[c]:cell_start[c + 1]]
+        cell_ids = (self.y_bins - self.y0)*shape[1] + (self.x_bins - self.x0)
+        self._cell_rows = np.argsort(cell_ids, kind='stable')
+        self._cell_start = np.zeros(shape[0]*shape[1] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cell_ids.astype(np.int64), minlength=shape[0]*shape[1]), out=self._cell_start[1:])
+
+    def window(self, x_min, x_max, y_min, y_max):
+        """
+        Return the bins of inspection_df with x_min <= x_bin <= x_max and
+        y_min <= y_bin <= y_max (the min bin of each cell)
+        """
+        x_start, x_stop = max(x_min - self.x0, 0), max(x_max - self.x0 + 1, 0)
+        y_start, y_stop = max(y_min - self.y0, 0), max(y_max - self.y0 + 1, 0)
+        rows = self.rows[y_start:y_stop, x_start:x_stop].ravel()
+        return self.inspection_df.iloc[np.sort(rows[rows >= 0])]
+
+    # cells at chebyshev distance r of (cx, cy), in grid coordinates
+    def _ring(self, cx, cy, r):
+        height, width = self.shape
+        if r == 0:
+            return np.array([cy*width + cx], dtype=np.int64)
+        x_start, x_stop = max(cx - r, 0), min(cx + r, width - 1) + 1
+        y_start, y_stop = max(cy - r + 1, 0), min(cy + r - 1, height - 1) + 1
+        ys, xs = [], []
+        for row in (cy - r, cy + r):
+            if 0 <= row < height:
+                xs.append(np.arange(x_start, x_stop))
+                ys.append(np.full(x_stop - x_start, row))
+        for column in (cx - r, cx + r):
+            if 0 <= column < width:
+                ys.append(np.arange(y_start, y_stop))
+                xs.append(np.full(max(y_stop - y_start, 0), column))
+        return np.concatenate(ys)*width + np.concatenate(xs)
+
+    def nearest(self, x, y, k=1, target=None):
+        """
+        Return the k bins nearest to (x, y) in bin units, closest first (ties
+        by position in inspection_df), with a 'distance' column; only bins
+        below target thickness if given
+
+        The grid is searched in square rings outward from the cell of (x, y)
+        until no further ring can hold a closer bin, so a query costs
+        O(r^2 + bins in those cells) for the radius r reaching the k-th
+        nearest bin, instead of O(n) over all bins.
+        """
+        height, width = self.shape
+        thickness = self.inspection_df.thickness.to_numpy()
+        cx, cy = int(np.floor(x + 0.5)) - self.x0, int(np.floor(y + 0.5)) - self.y0
+        # rings that touch the grid
+        first_ring = max(0, -cx, cx - (width - 1), -cy, cy - (height - 1))
+        last_ring = max(cx, width - 1 - cx, cy, height - 1 - cy)
+
+        rows, distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        found = 0
+        for r in range(first_ring, last_ring + 1) if k > 0 else ():
+            # (x, y) is within half a bin of its cell, so bins of ring r are
+            # at least r - 0.5 away
+            if found >= k and np.partition(np.concatenate(distances), k - 1)[k - 1] < r - 0.5:
+                break
+            cells = self._ring(cx, cy, r)
+            starts = self._cell_start[cells]
+            counts = self._cell_start[cells + 1] - starts
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            ring_rows = self._cell_rows[np.repeat(starts, counts) + offsets]
+            if target is not None:
+                ring_rows = ring_rows[below_target(thickness[ring_rows], target)]
+            rows.append(ring_rows)
+            distances.append(np.hypot(self.x_bins[ring_rows] - x, self.y_bins[ring_rows] - y))
+            found += len(ring_rows)
+
+        rows, distances = np.concatenate(rows), np.concatenate(distances)
+        closest = np.lexsort((rows, distances))[:k]
+        return self.inspection_df.iloc[rows[closest]].assign(distance=distances[closest])
+
+
+# connected components of cells given by (x, y) bin coordinates
+def label_cells(x_bins, y_bins, connectivity=8):
+    """
+    Label the connected components of a set of cells
+
+    inputs:
+        - x_bins, y_bins - integer coordinates of the cells (unique)
+        - connectivity - 4 (edges) or 8 (edges and corners)
+    outputs:
+        - labels - component of each cell, 0..n_components-1 in order of first
+          cell (by y_bin, then x_bin)
+    """
+    x_bins = np.asarray(x_bins, dtype=np.int64)
+    y_bins = np.asarray(y_bins, dtype=np.int64)
+    n = len(x_bins)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # linear cell ids on a grid padded by one cell, for neighbour lookups
+    x_bins = x_bins - x_bins.min() + 1
+    y_bins = y_bins - y_bins.min() + 1
+    width = int(x_bins.max()) + 2
+    ids = y_bins*width + x_bins
+    order = np.argsort(ids)
+    sorted_ids = ids[order]
+
+    # edges to the neighbouring cells that exist
+    sources, targets = [], []
+    for dx, dy in NEIGHBOURS[connectivity]:
+        neighbour_ids = ids + dy*width + dx
+        positions = np.minimum(np.searchsorted(sorted_ids, neighbour_ids), n - 1)
+        found = sorted_ids[positions] == neighbour_ids
+        sources.append(np.flatnonzero(found))
+        targets.append(order[positions[found]])
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+
+    # hook every root onto the smallest label of its edges, then compress the
+    # pointers, until no edge joins two labels
+    labels = np.arange(n)
+    while True:
+        smallest = np.minimum(labels[sources], labels[targets])
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[sources], smallest)
+        np.minimum.at(hooked, labels[targets], smallest)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            break
+        labels = hooked
+
+    # number the components by first cell
+    _, first, labels = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(ids[first], kind='stable')] = np.arange(len(first))
+    return rank[labels]
+
+
+# corrosion patches of an inspection
+def find_patches(inspection_df, target, connectivity=8):
+    """
+    Take an inspection df and group the bins below a target thickness into
+    patches of touching bins
+
+    inputs:
+        - inspection_df - binned data from inspection
+        - target - thickness (ie nominal*threshold)
+        - connectivity - 4 (edges) or 8 (edges and corners) touching bins
+    outputs:
+        - patch_df - one row per patch, largest first, with columns:
+            - 'patch' - patch number
+            - 'bins' - area in bins
+            - 'tubes' - count of unique customer_x
+            - 'min_t' - min thickness in the patch
+            - 'x_bin_min', 'x_bin_max', 'y_bin_min', 'y_bin_max' - bounding box
+        - labels - patch number of each bin of inspection_df, -1 if not below
+          target
+    """
+    critical = np.flatnonzero(below_target(inspection_df.thickness.to_numpy(), target))
+    critical_df = inspection_df.iloc[critical]
+
+    x_bins = critical_df.x_bin.to_numpy().astype(np.int64)
+    y_bins = critical_df.y_bin.to_numpy().astype(np.int64)
+    patch = np.zeros(len(critical), dtype=np.int64)
+    if len(critical):
+        # bins sharing a cell are one cell of the patch
+        width = int(x_bins.max() - x_bins.min()) + 1
+        cell_ids = (y_bins - y_bins.min())*width + (x_bins - x_bins.min())
+        _, first, cells = np.unique(cell_ids, return_index=True, return_inverse=True)
+        patch = label_cells(x_bins[first], y_bins[first], connectivity)[cells.ravel()]
+
+    labels = np.full(len(inspection_df), -1, dtype=np.int64)
+    labels[critical] = patch
+
+    grouped = critical_df.assign(patch=patch).groupby('patch', sort=True, observed=True)
+    patch_df = pd.DataFrame({
+        'bins': grouped.size(),
+        'tubes': grouped.customer_x.nunique(),
+        'min_t': grouped.thickness.min(),
+        'x_bin_min': grouped.x_bin.min(),
+        'x_bin_max': grouped.x_bin.max(),
+        'y_bin_min': grouped.y_bin.min(),
+        'y_bin_max': grouped.y_bin.max(),
+    }).rename_axis('patch').reset_index()
+    patch_df = patch_df.sort_values(['bins', 'patch'], ascending=[False, True], ignore_index=True)
+
+    return patch_df, labels
@@ -1,30 +1,27 @@
-import pandas as pd
-import requests
+import numpy as np
 
-from ..inspection_analysis.tokens import token
+from ..inspection_analysis.cache import get_default_cache
+from ..inspection_analysis.fetch import DEFAULT_MAX_WORKERS, headers, prod
+from ..reference.constants import HALLADOR_NOMINAL_OVERRIDES, NOMINAL_OVERRIDES
 
-
-# production url components for portal-service deliverables
-prod = {
-    "url_start": "https://portal-service.cloud.geckorobotics.com/api/v1/deliverables/",
-    "url_end": "/binned_plot_data.json", 
-    "token": token
-}
-
-# headers
-headers = {
-    "accept": "application/json", 
-    "Authorization": f"Bearer {prod['token']}"
-}
+# prod and headers moved to fetch, they are re-exported for existing imports
+__all__ = [
+    'prod', 'headers',
+    'get_inspection_df', 'LOSS_BINS', 'CRITS_PER10K_LOSS', 'loss_bin_label',
+    'tube_minima', 'count_below_sorted', 'below_target', 'count_below_thickness',
+    'analyze_inspection_df', 'hist_inspection_df', 'check_thickness',
+    'get_thickness_histogram', 'group_critdat',
+]
 
 
 # simplest request inspection df from portal service
-def get_inspection_df(inspection_slug):
+def get_inspection_df(inspection_slug, cache=None):
     """
     Take an inspection slug and return the inspection_df
     
     inputs:
         - inspection slug as string
+        - cache - InspectionCache to read through, defaults to the shared cache
     outputs:
         - inspection_df with columns:
             - plot_y
@@ -34,28 +31,128 @@ def get_inspection_df(inspection_slug):
             - y_bin
             - plot_x
             - thickness
+          or None if the request failed or returned no data
     """
+    cache = cache or get_default_cache()
     
     print(f"Making Req...")
-    req = requests.get(f"{prod['url_start']}{inspection_slug}{prod['url_end']}", headers=headers)
-    #print(f"\tRequest Text: {req.text}")
-    print(f"...Req Done")
-    
+    inspection_df = None
     try:
-        inspection_df = pd.DataFrame(req.json()['plots'][0]['data'])
-    except:
-        print(f"\tRequest Text: {req.text}")
+        inspection_df = cache.get(inspection_slug)
+    except Exception as e:
+        print(f"\tRequest Error: {e!r}")
+    print(f"...Req Done")
     
     return inspection_df
 
 
+# list of target bins (defined as a % loss, so .1 = 10% loss from nominal)
+LOSS_BINS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+# loss bin behind the crits_per10k stat
+CRITS_PER10K_LOSS = 0.4
+
+
+# column header of a loss bin (ie .1 => '10% Loss')
+def loss_bin_label(loss):
+    """
+    Take a loss fraction and return its column label, keeping fractional
+    percents of fine grids (ie .125 => '12.5% Loss')
+    """
+    return '{:g}% Loss'.format(round(loss*100, 6))
+
+
+# min t per tube
+def tube_minima(inspection_df):
+    """
+    Take inspection df and return a series of the min thickness per customer_x
+    """
+    return inspection_df.groupby('customer_x', sort=False, observed=True)['thickness'].min()
+
+
+# count sorted values below targets
+def count_below_sorted(sorted_values, targets):
+    """
+    Take a sorted array and return the number of values < each target
+
+    float32 values (compact frames) stand for the decimal thickness they were
+    rounded from, so values equal to a target at float32 precision are
+    compared as decimals and the counts match float64 data.
+    """
+    targets = np.asarray(targets, dtype=float)
+    if sorted_values.dtype != np.float32:
+        return np.searchsorted(sorted_values, targets, side='left')
+
+    targets_32 = targets.astype(np.float32)
+    counts = np.searchsorted(sorted_values, targets_32, side='left')
+    ties = np.searchsorted(sorted_values, targets_32, side='right')
+    for i in np.flatnonzero(ties > counts):
+        if float(str(targets_32[i])) < targets[i]:
+            counts[i] = ties[i]
+    return counts
+
+
+# mask of values below a target
+def below_target(values, target):
+    """
+    Take an array and return the boolean mask of values < target, with the
+    float32 ties of count_below_sorted
+    """
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        return values < target
+    target_32 = np.float32(target)
+    if float(str(target_32)) < target:
+        return values <= target_32
+    return values < target_32
+
+
+# single pass threshold counts
+def count_below_thickness(inspection_df, targets):
+    """
+    Take inspection df and count tubes and bins below each target thickness
+
+    Thickness and the per tube minima are sorted once, then every target is a
+    binary search, so any number of targets costs about the same.
+
+    inputs:
+        - inspection_df - binned data from inspection
+        - targets - list/array of target thicknesses
+    outputs:
+        - min_t - the min thickness bin
+        - max_t - the max thickness bin
+        - tubes_inspected - count of the number of unique customer_x
+        - bins_collected - count of bins
+        - tube_counts - array of # of tubes with min t < each target
+        - bin_counts - array of # of bins with t < each target
+    """
+    # get min/max
+    min_t = inspection_df.thickness.min()
+    max_t = inspection_df.thickness.max()
+
+    # count tubes (or stripes ?) and bins
+    tubes_inspected = inspection_df.customer_x.nunique()
+    bins_collected = inspection_df.shape[0]
+
+    # get min t per tube, sorted (NaN sorts last, so it is never counted)
+    min_t_by_tube = np.sort(tube_minima(inspection_df).to_numpy())
+    sorted_t = np.sort(inspection_df.thickness.to_numpy())
+
+    # number of values strictly below each target
+    tube_counts = count_below_sorted(min_t_by_tube, targets)
+    bin_counts = count_below_sorted(sorted_t, targets)
+
+    return min_t, max_t, tubes_inspected, bins_collected, tube_counts, bin_counts
+
+
 # main utility for analyzing a single inspection df
 def analyze_inspection_df(inspection_df, nominal, threshold):
     """
     Take inspection df and return key thickness stats based on target threshold
     
     inputs:
-        - inspection_df - binned data from inspection
+        - inspection_df - binned data from inspection (or a compact frame,
+          see frames.compact_inspection_df)
         - nominal - designed thickness, t at time 0
         - threshold - target threshold for count (ie 40% => threshold = .6)
     output:
@@ -66,34 +163,25 @@ def analyze_inspection_df(inspection_df, nominal, threshold):
         - critical_tubes_count - count of customer_x where >= 1 t is < target t
         - critical_bins_count - count of bins where t is < target t
     """
-    # get min/max
-    min_t = inspection_df.thickness.min()
-    max_t = inspection_df.thickness.max()
-    
     # calculate target t from nominal and threshold (example: .6*nominal = target)
     target = nominal*threshold
     
-    # count tubes (or stripes ?) and bins
-    tubes_inspected = inspection_df.customer_x.nunique()
-    bins_collected = inspection_df.shape[0]
-    
-    # get min t per bin
-    min_t_by_tube_list = inspection_df.groupby(['customer_x'])['thickness'].min().to_list()
-    
     # count tubes and bins with critical reading
-    critical_tubes_count = len([t for t in min_t_by_tube_list if t < target])
-    critical_bins_count = len([t for t in inspection_df.thickness if t < target])
+    min_t, max_t, tubes_inspected, bins_collected, tube_counts, bin_counts = count_below_thickness(inspection_df, [target])
     
-    return min_t, max_t, tubes_inspected, bins_collected, critical_tubes_count, critical_bins_count
+    return min_t, max_t, tubes_inspected, bins_collected, int(tube_counts[0]), int(bin_counts[0])
 
 
 # get histogram analysis of inspection_df
-def hist_inspection_df(inspection_df, nominal):
+def hist_inspection_df(inspection_df, nominal, loss_bins=LOSS_BINS):
     """
     Take inspection df and return key stats for a range of thickness thresholds
     inputs:
-        - inspection_df - binned data from inspection
+        - inspection_df - binned data from inspection (or a compact frame,
+          see frames.compact_inspection_df)
         - nominal - designed thickness, t at time 0
+        - loss_bins - loss fractions to count (default 10% to 90% in 10% steps,
+          any grid works, ie np.arange(.01, 1, .01) for 1% steps)
     outputs:
         - min_t - the min thickness bin
         - max_t - the max thickness bin
@@ -102,48 +190,24 @@ def hist_inspection_df(inspection_df, nominal):
         - tube_hist_bin_counts - list of # of crit tubes based on each threshold bin
         - bin_hist_bin_counts - list of # of crit bins based on each threshold bin
     """
-    # get min/max
-    min_t = inspection_df.thickness.min()
-    max_t = inspection_df.thickness.max()
-    
-    # list of target bins (defined as a % loss, so .1 = 10% loss from nominal)
-    bins = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-    
-    # count tubes (or stripes ?) and bins 
-    tubes_inspected = inspection_df.customer_x.nunique()
-    bins_collected = inspection_df.shape[0]
-    
-    # get min t per bin
-    min_t_by_tube_list = inspection_df.groupby(['customer_x'])['thickness'].min().to_list()
-    
-    # initialize empty lists
-    tube_hist_bin_counts = []
-    bin_hist_bin_counts = []
+    # define targets
+    targets = [nominal*(1-bini) for bini in loss_bins]
     
-    # iterate through target bins, count tubes and bins w t < target
-    for bini in bins:
-        # TODO: unused atm, but would be better way to create column headers
-        bin_string = '{}%'.format(str(round(bini*100))) + ' Loss'
-        # define target
-        target = nominal*(1-bini)
-        # calculate crit counts
-        critical_tubes_count = len([t for t in min_t_by_tube_list if t < target])
-        critical_bins_count = len([t for t in inspection_df.thickness if t < target])
-        # append to lists
-        tube_hist_bin_counts.append(critical_tubes_count)
-        bin_hist_bin_counts.append(critical_bins_count)
-        
+    # count tubes and bins w t < target, for all targets in one pass
+    min_t, max_t, tubes_inspected, bins_collected, tube_counts, bin_counts = count_below_thickness(inspection_df, targets)
     
-    return min_t, max_t, tubes_inspected, bins_collected, tube_hist_bin_counts, bin_hist_bin_counts
+    return min_t, max_t, tubes_inspected, bins_collected, tube_counts.tolist(), bin_counts.tolist()
 
 
 # check_thickness does large scale analysis of a df containing inspection slugs
-def check_thickness(targets_df, threshold):
+def check_thickness(targets_df, threshold, max_workers=DEFAULT_MAX_WORKERS, cache=None):
     """
     Takes a dataframe of target inspection slugs and their nominals and returns analysis data
     inputs: 
         - targets_df - contains slug and nominal headers
         - threshold - float (example = 0.6)
+        - max_workers - number of inspections downloaded concurrently
+        - cache - InspectionCache to read through, defaults to the shared cache
     outputs: 
         - data_df - df containing the following columns where 1 row is one inspection
             - columns:
@@ -157,64 +221,30 @@ def check_thickness(targets_df, threshold):
                 - 'critical_bins'
         - error_list - list of slugs where an error was encountered
     """
-    # initialize empy lists
-    data_list = []
-    error_slug_list = []
-
-    # iterate through target inspections
-    for row in range(len(targets_df)):
-        inspection_slug = targets_df.loc[row, 'slug']
-        nominal = targets_df.loc[row, 'nominal']
-        
-        # print every tenth row num as a progress tracker
-        if row%10 == 0:
-            print('{}/{}'.format(row, targets_df.shape[0]))
-            
-        ## clean data for hallador units with bad nominals
-        hallador_unit_1 = ['20220523-332ac6', '20220523-64417d']
-        hallador_unit_2 = ['20221011-7c7e5f', '20221011-18c8e9']
-        
-        if inspection_slug in hallador_unit_1:
-            nominal = 0.28
-        if inspection_slug in hallador_unit_2:
-            nominal = 0.26
-        # end hackery for bad nominals
-
-        # req for inspection data
-        req = requests.get(f"{prod['url_start']}{inspection_slug}{prod['url_end']}", headers=headers)
-        # if we got data...
-        if req.json():
-            try:
-                # convert to df
-                inspection_df = pd.DataFrame(req.json()['plots'][0]['data'])
-
-                # analyze the df returned
-                min_t, max_t, tubes_inspected, bins_collected, critical_tubes_count, critical_bins_count = analyze_inspection_df(inspection_df, nominal, threshold)
-
-                # convert to a row
-                data = [inspection_slug, nominal, min_t, max_t, tubes_inspected, bins_collected, critical_tubes_count, critical_bins_count]
-                
-                # append row to list
-                data_list.append(data)
-            except:
-                print('Error: No plots record on req.json ...')
-                error_slug_list.append(inspection_slug)
-            
-        else:
-            print('Inspection slug failed to return data: {}'.format(inspection_slug))
-
-    # compile data list of lists into dataframe
-    data_df = pd.DataFrame(data_list, columns=['slug', 'nominal', 'min_t', 'max_t', 'tubes_inspected', 'bins_collected', 'critical_tubes', 'critical_bins'])
-    
+    # local import, the pipeline builds on the helpers above
+    from ..inspection_analysis.pipeline import SummaryStage, ThresholdStage, run_pipeline
+
+    data_df, error_df = run_pipeline(
+        targets_df,
+        [SummaryStage(), ThresholdStage(threshold)],
+        nominal_overrides=HALLADOR_NOMINAL_OVERRIDES,
+        max_workers=max_workers,
+        cache=cache,
+    )
+    error_slug_list = error_df.loc[error_df.kind == 'error', 'slug'].tolist()
+
     return data_df, error_slug_list
 
 
 # get histogram analysis for targets df
-def get_thickness_histogram(targets_df):
+def get_thickness_histogram(targets_df, max_workers=DEFAULT_MAX_WORKERS, cache=None, loss_bins=LOSS_BINS):
     """
     Takes a dataframe of target inspection slugs and nominals and returns histogram analysis data
     inputs: 
         - targets_df - contains slug and nominal headers
+        - loss_bins - loss fractions to count, see hist_inspection_df
+        - max_workers - number of inspections downloaded concurrently
+        - cache - InspectionCache to read through, defaults to the shared cache
     outputs:
         - data_df - df containing the following columns where 1 row is one inspection
             - columns:
@@ -228,87 +258,18 @@ def get_thickness_histogram(targets_df):
                 - Bins by Loss bin
         - error_list - list of slugs where an error was encountered
     """
-    # initialize empty lists
-    data_list = []
-    error_slug_list = []
-
-    # iterate through target inspections
-    for row in range(len(targets_df)):
-        inspection_slug = targets_df.loc[row, 'slug']
-        nominal = targets_df.loc[row, 'nominal']
-        
-        # print every tenth row num as a progress tracker
-        if row%10 == 0:
-            print('{}/{}'.format(row, targets_df.shape[0]))
-            
-        ## clean data for hallador units with bad nominals
-        hallador_unit_1 = ['20220523-332ac6', '20220523-64417d']
-        hallador_unit_2 = ['20221011-7c7e5f', '20221011-18c8e9']
-        
-        if inspection_slug in hallador_unit_1:
-            nominal = 0.28
-        if inspection_slug in hallador_unit_2:
-            nominal = 0.26
-        # hack gibson slopes nominal
-        if inspection_slug == '20221004-565f7b':
-            nominal = 0.203
-        # end hackery for bad nominals
-
-        # req for inspection data
-        req = requests.get(f"{prod['url_start']}{inspection_slug}{prod['url_end']}", headers=headers)
-        # if we got data...
-        if req.json():
-            try:
-                # convert to df
-                inspection_df = pd.DataFrame(req.json()['plots'][0]['data'])
-
-                # analyze the df returned
-                min_t, max_t, tubes_inspected, bins_collected, tube_hist_bin_counts, bin_hist_bin_counts = hist_inspection_df(inspection_df, nominal)
-                
-                # add 40%loss per 10k bins stat:
-                crits_per10k = round(((bin_hist_bin_counts[3])/bins_collected)*10000)
-
-                # convert to a row
-                data = [inspection_slug, nominal, min_t, max_t, tubes_inspected, bins_collected, crits_per10k] + tube_hist_bin_counts + bin_hist_bin_counts
-
-                # append row to list
-                data_list.append(data)
-            except:
-                print('Error: No plots record on req.json ...')
-                error_slug_list.append(inspection_slug)
-            
-        else:
-            print('Inspection slug failed to return data: {}'.format(inspection_slug))
-
-    # build data df
-    data_df = pd.DataFrame(data_list, columns=[
-        'slug', 
-        'nominal', 
-        'min_t', 
-        'max_t', 
-        'tubes_inspected', 
-        'bins_collected',
-        'crits_per10k',
-        'Tubes w 10% Loss',
-        'Tubes w 20% Loss',
-        'Tubes w 30% Loss',
-        'Tubes w 40% Loss',
-        'Tubes w 50% Loss',
-        'Tubes w 60% Loss',
-        'Tubes w 70% Loss',
-        'Tubes w 80% Loss',
-        'Tubes w 90% Loss',
-        'Bins w 10% Loss',
-        'Bins w 20% Loss',
-        'Bins w 30% Loss',
-        'Bins w 40% Loss',
-        'Bins w 50% Loss',
-        'Bins w 60% Loss',
-        'Bins w 70% Loss',
-        'Bins w 80% Loss',
-        'Bins w 90% Loss',
-    ])
-    
+    # local import, the pipeline builds on the helpers above
+    from ..inspection_analysis.pipeline import LossHistogramStage, SummaryStage, run_pipeline
+
+    data_df, error_df = run_pipeline(
+        targets_df,
+        [SummaryStage(), LossHistogramStage(loss_bins)],
+        nominal_overrides=NOMINAL_OVERRIDES,
+        max_workers=max_workers,
+        cache=cache,
+    )
+    error_slug_list = error_df.loc[error_df.kind == 'error', 'slug'].tolist()
+
     return data_df, error_slug_list
 
 
@@ -319,19 +280,21 @@ def group_critdat(comb_df, groupon_list):
     
     Inputs:
         - comb_df - return of check_thickness merged with reference data
+          (categorical or compact integer columns are fine, only groups that
+          occur are returned)
         - groupon_list - list of ref_df columns to groupby
     Outputs:
         - grouped df w sum of analysis metrics
     """
     # groupby crit analysis and sum
-    crits_df = comb_df.groupby(groupon_list)[
+    crits_df = comb_df.groupby(groupon_list, observed=True)[[
         'tubes_inspected',	
         'bins_collected', 
         'critical_tubes', 
         'critical_bins'
-    ].sum().reset_index()
+    ]].sum().reset_index()
     # groupby and count inspections
-    count_df = comb_df.groupby(groupon_list)['slug'].nunique().to_frame().reset_index()
+    count_df = comb_df.groupby(groupon_list, observed=True)['slug'].nunique().to_frame().reset_index()
     # merge the counts and the summed crit analysis
     merged_df = count_df.merge(crits_df, how='outer', on=groupon_list)
     # rename slug to inspections (count of)
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+
+# default hops from an inspection up to its customer
+DEFAULT_PATH = ['unit', 'site', 'organization']
+
+# default attributes of each hop in resolve
+DEFAULT_ATTRIBUTES = ['id', 'data.portal.name']
+
+
+# value at a dotted key of an entry (ie 'data.portal.slug'), or None
+def _entry_value(entry, key):
+    value = entry
+    for part in key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+class EntityGraph:
+    """
+    Rolodex entries as a graph with integer node ids and CSR adjacency
+
+    Every entry is a node (0..n-1, by first appearance, the latest copy of an
+    entry wins). Edges are named after the linked entry type (ie 'unit',
+    'site') and come from:
+        - links - (entry_id, link_type, target_id) as returned by rolodex_load
+          links or stored in a RolodexReplica
+        - tags - an entry tagged {type: slug} is linked to the entry of that
+          type carrying the same tag (ie a unit tagged {'site': 's'} to the
+          site tagged {'site': 's'}), so hops missing from the loaded links
+          still resolve
+    Each edge type is held as indptr/indices arrays, so a hop for many nodes
+    is a couple of array lookups. Explicit links come before tag links.
+
+    inputs:
+        - entries - iterable of rolodex entries (dicts with id, type, tags,
+          data)
+        - links - iterable of (entry_id, link_type, target_id)
+    """
+
+    def __init__(self, entries, links=()):
+        self._node = {}
+        self.entries = []
+        for entry in entries:
+            entry_id = str(entry['id'])
+            if entry_id in self._node:
+                self.entries[self._node[entry_id]] = entry
+            else:
+                self._node[entry_id] = len(self.entries)
+                self.entries.append(entry)
+        self.types = pd.Categorical([entry.get('type') for entry in self.entries])
+        self._attributes = {}
+        self._indexes = {}
+
+        # edges from links, then from tags
+        sources, relations, targets = [], [], []
+        for entry_id, link_type, target_id in links:
+            source, target = self._node.get(str(entry_id)), self._node.get(str(target_id))
+            if source is not None and target is not None:
+                sources.append(source)
+                relations.append(link_type)
+                targets.append(target)
+        owners = {}
+        for node, entry in enumerate(self.entries):
+            own_tag = (entry.get('tags') or {}).get(entry.get('type'))
+            if own_tag is not None:
+                owners.setdefault((entry.get('type'), own_tag), node)
+        for node, entry in enumerate(self.entries):
+            for tag_type, value in (entry.get('tags') or {}).items():
+                target = owners.get((tag_type, value))
+                if target is not None and target != node:
+                    sources.append(node)
+                    relations.append(tag_type)
+                    targets.append(target)
+
+        self._csr = {}
+        sources = np.array(sources, dtype=np.int64)
+        targets = np.array(targets, dtype=np.int64)
+        relation_codes, relation_names = pd.factorize(pd.Series(relations, dtype=object))
+        for code, relation in enumerate(relation_names):
+            selected = relation_codes == code
+            relation_sources, relation_targets = sources[selected], targets[selected]
+            # drop repeated edges, keep the first (links before tags)
+            _, first = np.unique(relation_sources*len(self.entries) + relation_targets, return_index=True)
+            first.sort()
+            relation_sources, relation_targets = relation_sources[first], relation_targets[first]
+            order = np.argsort(relation_sources, kind='stable')
+            indptr = np.zeros(len(self.entries) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(relation_sources, minlength=len(self.entries)), out=indptr[1:])
+            self._csr[relation] = (indptr, relation_targets[order])
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build the graph of rolodex_load records (entries and their links)
+        """
+        entries = []
+        links = []
+        for record in records:
+            entries.append(record['entry'])
+            for link_type, linked in (record.get('links') or {}).items():
+                if linked:
+                    entries.append(linked)
+                    links.append((record['entry']['id'], link_type, linked['id']))
+        return cls(entries, links)
+
+    @classmethod
+    def from_replica(cls, replica, entry_types=None):
+        """
+        Build the graph of the entries (of entry_types if given) and links
+        stored in a RolodexReplica
+        """
+        return cls(replica.entries(entry_types), replica.links())
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def relations(self):
+        return list(self._csr)
+
+    def nodes(self, entry_ids):
+        """
+        Return the node of each entry id, -1 if not in the graph
+        """
+        return np.array([self._node.get(str(entry_id), -1) for entry_id in entry_ids], dtype=np.int64)
+
+    def neighbours(self, nodes, relation):
+        """
+        Return the first node linked to each node by relation, -1 for nodes
+        without one (or -1 nodes)
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        result = np.full(len(nodes), -1, dtype=np.int64)
+        if relation not in self._csr:
+            return result
+        indptr, indices = self._csr[relation]
+        valid = nodes >= 0
+        starts = indptr[nodes[valid]]
+        found = indptr[nodes[valid] + 1] > starts
+        result[np.flatnonzero(valid)[found]] = indices[starts[found]]
+        return result
+
+    def attribute(self, nodes, key):
+        """
+        Return the value at a dotted key (ie 'id', 'data.portal.name') of
+        each node, None for -1 nodes
+        """
+        if key not in self._attributes:
+            # one extra None so node -1 reads as missing
+            values = np.empty(len(self.entries) + 1, dtype=object)
+            values[:-1] = [_entry_value(entry, key) for entry in self.entries]
+            self._attributes[key] = values
+        return self._attributes[key][np.asarray(nodes, dtype=np.int64)]
+
+    def lookup(self, values, key='data.portal.slug', entry_type='inspection'):
+        """
+        Return the node of entry_type whose dotted key equals each value (the
+        first one if several), -1 if none
+        """
+        if (key, entry_type) not in self._indexes:
+            candidates = np.arange(len(self.entries)) if entry_type is None else np.flatnonzero(self.types == entry_type)
+            keys = pd.Series(self.attribute(candidates, key), index=candidates)
+            keys = keys[keys.notna() & ~keys.duplicated()]
+            self._indexes[(key, entry_type)] = (pd.Index(keys.to_numpy()), keys.index.to_numpy())
+        index, nodes = self._indexes[(key, entry_type)]
+        positions = index.get_indexer(pd.Index(values, dtype=object)) if len(index) else np.full(len(values), -1)
+        return np.where(positions >= 0, nodes[positions], -1)
+
+    # multi-hop resolution to a flat table
+    def resolve(self, values, path=DEFAULT_PATH, attributes=DEFAULT_ATTRIBUTES, key='data.portal.slug', entry_type='inspection', key_column='slug'):
+        """
+        Take entry keys (ie inspection slugs) and follow a path of relations
+        from each, all keys at once per hop
+
+        inputs:
+            - values - keys of the starting entries
+            - path - relations to follow in turn, ie ['unit', 'site',
+              'organization'] for inspection -> unit -> site -> organization
+            - attributes - dotted keys to report at each hop, or a dict of
+              relation -> list of keys
+            - key, entry_type - how the starting entries are found (see
+              lookup)
+            - key_column - name of the values column
+        outputs:
+            - mapping_df - one row per value, with key_column and a
+              '<relation>.<attribute>' column per hop and attribute (missing
+              where a hop is missing), ie to merge on check_thickness output
+        """
+        values = list(values)
+        mapping = {key_column: values}
+        nodes = self.lookup(values, key, entry_type)
+        for relation in path:
+            nodes = self.neighbours(nodes, relation)
+            hop_attributes = attributes.get(relation, DEFAULT_ATTRIBUTES) if isinstance(attributes, dict) else attributes
+            for attribute in hop_attributes:
+                mapping[f'{relation}.{attribute}'] = self.attribute(nodes, attribute)
+        return pd.DataFrame(mapping)
@@ -1,10 +1,27 @@
+import concurrent.futures
 import json
 import requests
 
+import pandas as pd
+
+from ..inspection_analysis.fetch import DEFAULT_MAX_WORKERS, DEFAULT_TIMEOUT, make_session
 from ..inspection_analysis.tokens import token
 
-def rolodex_load(entry_type, links=[], filters=[], ids=[], tags={}, limit=100000):
-    url = "https://rolodex.cloud.geckorobotics.com/api/v2/entries/load"
+# rolodex entries load endpoint
+url_load = "https://rolodex.cloud.geckorobotics.com/api/v2/entries/load"
+
+# entries per page of the paginated loaders
+DEFAULT_PAGE_SIZE = 2000
+
+def rolodex_load(entry_type, links=[], filters=[], ids=[], tags={}, limit=100000, replica=None):
+    # answer from a local replica if one is given or configured
+    # (see rolodex_replica.configure_replica)
+    from ..interfaces.rolodex_replica import get_default_replica
+    replica = replica or get_default_replica()
+    if replica is not None:
+        return replica.get(entry_type, links, filters, ids, tags, limit)
+
+    url = url_load
     headers = {
         "Accept": "application/json",
         "Authorization": "Bearer "+token,
@@ -22,5 +39,155 @@ def rolodex_load(entry_type, links=[], filters=[], ids=[], tags={}, limit=100000
 
     req = requests.post(url, data=json.dumps(post_body), headers=headers)
     data = req.json()
-    
-    return data
\ No newline at end of file
+
+    return data
+
+
+# one page of a rolodex load
+def rolodex_load_page(entry_type, links=[], filters=[], ids=[], tags={}, offset=0, limit=DEFAULT_PAGE_SIZE, session=None, timeout=DEFAULT_TIMEOUT, url=None):
+    """
+    Take the rolodex_load arguments and return the entries offset to
+    offset+limit of the query
+
+    raises:
+        - requests.HTTPError for error responses (after retries)
+    """
+    if session is None:
+        with make_session(1) as session:
+            return rolodex_load_page(entry_type, links, filters, ids, tags, offset, limit, session, timeout, url)
+
+    post_body = {
+        "type": entry_type,
+        "links": links,
+        "filters": filters,
+        "ids": ids,
+        "tags": tags,
+        "offset": offset,
+        "limit": limit,
+    }
+    req = session.post(url or url_load, json=post_body, timeout=timeout)
+    req.raise_for_status()
+    return req.json()
+
+
+# paginated rolodex load
+def rolodex_iter_pages(entry_type, links=[], filters=[], ids=[], tags={}, limit=100000, page_size=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_MAX_WORKERS, session=None, timeout=DEFAULT_TIMEOUT, url=None):
+    """
+    Load rolodex entries a page at a time, max_workers pages concurrently
+    over one pooled session, and yield the pages in order
+
+    The query is the same as rolodex_load, split into offset/limit pages of
+    page_size entries. Loading stops at the first short page (or at limit
+    entries), so at most max_workers pages past the end are requested. Only
+    the pages in flight are held in memory.
+
+    inputs:
+        - entry_type, links, filters, ids, tags, limit - as for rolodex_load
+        - page_size - entries per request
+        - max_workers - concurrent requests
+        - session - requests session, defaults to a new pooled session
+          (closed when done)
+        - timeout - (connect, read) timeout in seconds
+        - url - load endpoint, defaults to url_load
+    outputs:
+        - generator of lists of entries (the rolodex_load records)
+    raises:
+        - requests.HTTPError if a page fails (after retries)
+        - ValueError if a page starts with an entry of an earlier page (the
+          endpoint ignored offset)
+    """
+    if session is None:
+        with make_session(max_workers) as session:
+            yield from rolodex_iter_pages(entry_type, links, filters, ids, tags, limit, page_size, max_workers, session, timeout, url)
+        return
+
+    offsets = iter(range(0, limit, page_size))
+    pending = {}
+    seen = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit():
+            for offset in offsets:
+                page_limit = min(page_size, limit - offset)
+                pending[offset] = (page_limit, pool.submit(
+                    rolodex_load_page, entry_type, links, filters, ids, tags,
+                    offset, page_limit, session, timeout, url,
+                ))
+                if len(pending) >= max_workers:
+                    return
+
+        try:
+            submit()
+            while pending:
+                # pages come back in any order but are yielded in order
+                offset = min(pending)
+                page_limit, future = pending.pop(offset)
+                page = future.result()
+                if page:
+                    if page[0]['entry']['id'] in seen:
+                        raise ValueError(f'rolodex returned entry {page[0]["entry"]["id"]} again at offset {offset}, the load endpoint does not page')
+                    seen.update(record['entry']['id'] for record in page)
+                    yield page
+                if len(page) < page_limit:
+                    break
+                submit()
+        finally:
+            for _, future in pending.values():
+                future.cancel()
+
+
+# paginated rolodex load, one entry at a time
+def rolodex_iter(entry_type, links=[], filters=[], ids=[], tags={}, limit=100000, page_size=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_MAX_WORKERS, session=None, timeout=DEFAULT_TIMEOUT, url=None):
+    """
+    Yield the entries of rolodex_load (same records, same order) as their
+    pages arrive, see rolodex_iter_pages
+    """
+    for page in rolodex_iter_pages(entry_type, links, filters, ids, tags, limit, page_size, max_workers, session, timeout, url):
+        yield from page
+
+
+# keep the columns of a flattened page
+def _select_columns(page_df, columns):
+    """
+    Keep the columns of page_df named in columns; a name ending in '.*' keeps
+    every column with that prefix (ie 'entry.tags.*')
+    """
+    keep = []
+    for column in columns:
+        if column.endswith('.*'):
+            keep.extend(c for c in page_df.columns if c.startswith(column[:-1]) and c not in keep)
+        elif column in page_df.columns and column not in keep:
+            keep.append(column)
+    return page_df[keep]
+
+
+# paginated rolodex load to a flat df
+def rolodex_load_df(entry_type, links=[], filters=[], ids=[], tags={}, limit=100000, columns=None, page_size=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_MAX_WORKERS, session=None, timeout=DEFAULT_TIMEOUT, url=None):
+    """
+    Load rolodex entries straight into a flat df, as pd.json_normalize of
+    rolodex_load (ie 'entry.data.portal.slug', 'entry.tags.unit',
+    'links.unit.data.portal.name' columns)
+
+    Each page is flattened (and cut down to columns) as it arrives, so the
+    nested entries of the whole query are never held at once.
+
+    inputs:
+        - entry_type, links, filters, ids, tags, limit - as for rolodex_load
+        - columns - flattened columns to keep, a name ending in '.*' keeps
+          all columns with that prefix (ie ['entry.id', 'entry.tags.*']);
+          default all
+        - page_size, max_workers, session, timeout, url - as for
+          rolodex_iter_pages
+    outputs:
+        - entries_df - one row per entry, in rolodex_load order
+    """
+    page_dfs = []
+    for page in rolodex_iter_pages(entry_type, links, filters, ids, tags, limit, page_size, max_workers, session, timeout, url):
+        page_df = pd.json_normalize(page)
+        if columns is not None:
+            page_df = _select_columns(page_df, columns)
+        page_dfs.append(page_df)
+
+    if not page_dfs:
+        return pd.DataFrame(columns=[c for c in columns or [] if not c.endswith('.*')])
+    return pd.concat(page_dfs, ignore_index=True)
@@ -0,0 +1,372 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from ..interfaces.rolodex_interface import DEFAULT_PAGE_SIZE, rolodex_iter_pages
+
+
+# default location of the rolodex replica
+DEFAULT_REPLICA_PATH = Path.home() / ".cache" / "davos" / "rolodex.sqlite"
+
+# ids per sqlite IN (...) batch
+_BATCH = 900
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_type ON entries (type);
+CREATE TABLE IF NOT EXISTS tags (
+    entry_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS tags_key_value ON tags (key, value);
+CREATE INDEX IF NOT EXISTS tags_entry ON tags (entry_id);
+CREATE TABLE IF NOT EXISTS links (
+    entry_id TEXT NOT NULL,
+    link_type TEXT NOT NULL,
+    target_id TEXT NOT NULL,
+    PRIMARY KEY (entry_id, link_type)
+);
+CREATE INDEX IF NOT EXISTS links_target ON links (target_id);
+CREATE TABLE IF NOT EXISTS syncs (
+    query TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL,
+    row_limit INTEGER NOT NULL,
+    returned INTEGER NOT NULL
+);
+"""
+
+
+# key of a load query, for sync bookkeeping
+def _query_key(entry_type, links, filters, ids, tags):
+    return json.dumps([entry_type, sorted(links), filters, sorted(map(str, ids)), tags], sort_keys=True)
+
+
+# links a query needs locally: its own, and the types its filters are on
+def _required_links(entry_type, links, filters):
+    return set(links) | {query_filter['type'] for query_filter in filters if query_filter.get('type', entry_type) != entry_type}
+
+
+# json path of a dotted filter key into the entry data
+def _data_path(key):
+    return '$.data' + ''.join('."{}"'.format(part.replace('"', '\\"')) for part in key.split('.'))
+
+
+def _batches(values):
+    values = list(values)
+    for start in range(0, len(values), _BATCH):
+        yield values[start:start + _BATCH]
+
+
+class RolodexReplica:
+    """
+    Local sqlite copy of rolodex entries, queried with the rolodex_load
+    arguments
+
+    Entries are stored once by id (whatever type or query they came from)
+    with secondary tables for their tags and links:
+        - entries - id, type, content hash, sync time and the entry json
+        - tags - (entry_id, key, value), indexed on (key, value)
+        - links - (entry_id, link_type, target_id) as returned by the last
+          sync with that link
+        - syncs - queries synced, and when
+    Only entries whose content changed are rewritten on sync.
+
+    inputs:
+        - path - sqlite file
+        - ttl - seconds before a synced query is synced again by get; None
+          never expires
+        - offline - never touch the network, unsynced queries raise
+          LookupError in get
+    """
+
+    def __init__(self, path=DEFAULT_REPLICA_PATH, ttl=None, offline=False):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.offline = offline
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(syncs)')]
+        if columns and 'row_limit' not in columns:
+            # syncs recorded without their limit can not tell what they cover
+            self._db.execute('DROP TABLE syncs')
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    # store entries (with their tags) whose content changed
+    def _upsert(self, entries, synced_at):
+        """
+        Return (added, changed) counts
+        """
+        entries = {str(entry['id']): entry for entry in entries}
+        hashes = {}
+        for batch in _batches(entries):
+            hashes.update(self._db.execute(
+                'SELECT id, hash FROM entries WHERE id IN ({})'.format(','.join('?'*len(batch))), batch,
+            ))
+
+        added = changed = 0
+        for entry_id, entry in entries.items():
+            body = json.dumps(entry, sort_keys=True)
+            digest = hashlib.sha1(body.encode()).hexdigest()
+            if hashes.get(entry_id) == digest:
+                continue
+            if entry_id in hashes:
+                changed += 1
+                self._db.execute('DELETE FROM tags WHERE entry_id = ?', (entry_id,))
+            else:
+                added += 1
+            self._db.execute(
+                # updated in place, so entries keep their (sync) order
+                'INSERT INTO entries (id, type, hash, synced_at, body) VALUES (?, ?, ?, ?, ?)'
+                ' ON CONFLICT (id) DO UPDATE SET type = excluded.type, hash = excluded.hash,'
+                ' synced_at = excluded.synced_at, body = excluded.body',
+                (entry_id, entry.get('type'), digest, synced_at, body),
+            )
+            self._db.executemany(
+                'INSERT INTO tags (entry_id, key, value) VALUES (?, ?, ?)',
+                [(entry_id, key, None if value is None else str(value)) for key, value in (entry.get('tags') or {}).items()],
+            )
+        return added, changed
+
+    def _delete(self, entry_ids):
+        for batch in _batches(entry_ids):
+            marks = ','.join('?'*len(batch))
+            self._db.execute(f'DELETE FROM entries WHERE id IN ({marks})', batch)
+            self._db.execute(f'DELETE FROM tags WHERE entry_id IN ({marks})', batch)
+            self._db.execute(f'DELETE FROM links WHERE entry_id IN ({marks}) OR target_id IN ({marks})', batch + batch)
+
+    # refresh a query from rolodex
+    def sync(self, entry_type, links=[], filters=[], ids=[], tags={}, limit=100000, prune=False, **page_kwargs):
+        """
+        Load a query from rolodex (paginated, see rolodex_iter_pages) and
+        store its entries and their linked entries
+
+        Each page is stored as it arrives, readers are not held up while a
+        page loads; the query is only synced (see synced_at) once all of its
+        pages are stored.
+
+        inputs:
+            - entry_type, links, filters, ids, tags, limit - as for
+              rolodex_load; the types filters are on are loaded as links too,
+              so the filters can be answered locally
+            - prune - delete the entries the query matched locally but no
+              longer returns
+            - page_kwargs - page_size, max_workers, session, timeout, url
+        outputs:
+            - dict of 'added', 'changed', 'unchanged' and 'removed' entry
+              counts (linked entries included)
+        """
+        synced_at = time.time()
+        counts = {'added': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+        seen = set()
+        stored = set()
+        returned = 0
+        links = sorted(_required_links(entry_type, links, filters))
+        page_kwargs.setdefault('page_size', DEFAULT_PAGE_SIZE)
+
+        if prune:
+            with self._lock:
+                previous = {str(record['entry']['id']) for record in self._load(entry_type, [], filters, ids, tags, limit)}
+        else:
+            previous = set()
+
+        # pages are loaded outside the lock, it is only held to store each one
+        for page in rolodex_iter_pages(entry_type, links, filters, ids, tags, limit, **page_kwargs):
+            entries = []
+            link_rows = []
+            returned += len(page)
+            for record in page:
+                entry = record['entry']
+                entries.append(entry)
+                seen.add(str(entry['id']))
+                found = record.get('links') or {}
+                for link_type in links:
+                    linked = found.get(link_type)
+                    if linked:
+                        entries.append(linked)
+                        link_rows.append((str(entry['id']), link_type, str(linked['id'])))
+
+            with self._lock, self._db:
+                added, changed = self._upsert(entries, synced_at)
+                # links of the query are replaced, links it did not ask for are kept
+                for batch in _batches({str(record['entry']['id']) for record in page}):
+                    self._db.execute(
+                        'DELETE FROM links WHERE entry_id IN ({}) AND link_type IN ({})'.format(','.join('?'*len(batch)), ','.join('?'*len(links))),
+                        batch + list(links),
+                    )
+                self._db.executemany('INSERT OR REPLACE INTO links (entry_id, link_type, target_id) VALUES (?, ?, ?)', link_rows)
+            counts['added'] += added
+            counts['changed'] += changed
+            stored.update(str(entry['id']) for entry in entries)
+
+        with self._lock, self._db:
+            removed = previous - seen
+            self._delete(removed)
+            counts['removed'] = len(removed)
+            counts['unchanged'] = len(stored) - counts['added'] - counts['changed']
+            self._db.execute(
+                'INSERT OR REPLACE INTO syncs (query, synced_at, row_limit, returned) VALUES (?, ?, ?, ?)',
+                (_query_key(entry_type, links, filters, ids, tags), synced_at, limit, returned),
+            )
+        return counts
+
+    def synced_at(self, entry_type, links=[], filters=[], ids=[], tags={}, limit=100000):
+        """
+        Return when the replica last held all of a query (time.time()), or
+        None
+
+        A sync covers the query if it loaded the links the query needs (its
+        links and the types of its filters) and either:
+            - was the same query, not cut short by its limit or with a limit
+              at least this one
+            - loaded all entries of the type (no filters, ids or tags) and
+              was not cut short by its limit
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT query, synced_at, row_limit, returned FROM syncs').fetchall()
+        required = _required_links(entry_type, links, filters)
+        _, _, *selection = json.loads(_query_key(entry_type, [], filters, ids, tags))
+        times = []
+        for query, synced_at, row_limit, returned in rows:
+            synced_type, synced_links, *synced_selection = json.loads(query)
+            if synced_type != entry_type or not required <= set(synced_links):
+                continue
+            complete = returned < row_limit
+            if (synced_selection == selection and (complete or row_limit >= limit)) or (
+                complete and synced_selection == [[], [], {}]
+            ):
+                times.append(synced_at)
+        return max(times) if times else None
+
+    # rolodex_load evaluated on the replica
+    def _load(self, entry_type, links, filters, ids, tags, limit):
+        where = ['e.type = ?']
+        params = [entry_type]
+        if ids:
+            where.append('e.id IN ({})'.format(','.join('?'*len(ids))))
+            params.extend(str(entry_id) for entry_id in ids)
+        for key, value in tags.items():
+            where.append('EXISTS (SELECT 1 FROM tags t WHERE t.entry_id = e.id AND t.key = ? AND t.value = ?)')
+            params.extend([key, str(value)])
+        for query_filter in filters:
+            if set(query_filter) - {'type', 'key', 'value'}:
+                raise ValueError(f'unsupported filter {query_filter}, only type/key/value equality filters are evaluated locally')
+            if query_filter.get('type', entry_type) == entry_type:
+                where.append('CAST(json_extract(e.body, ?) AS TEXT) = ?')
+                params.extend([_data_path(query_filter['key']), str(query_filter['value'])])
+            else:
+                where.append(
+                    'EXISTS (SELECT 1 FROM links l JOIN entries le ON le.id = l.target_id'
+                    ' WHERE l.entry_id = e.id AND l.link_type = ? AND CAST(json_extract(le.body, ?) AS TEXT) = ?)'
+                )
+                params.extend([query_filter['type'], _data_path(query_filter['key']), str(query_filter['value'])])
+        rows = self._db.execute(
+            'SELECT e.id, e.body FROM entries e WHERE {} ORDER BY e.rowid LIMIT ?'.format(' AND '.join(where)),
+            params + [limit],
+        ).fetchall()
+
+        records = {entry_id: {'entry': json.loads(body), 'links': {}} for entry_id, body in rows}
+        if links:
+            for batch in _batches(records):
+                linked = self._db.execute(
+                    'SELECT l.entry_id, l.link_type, le.body FROM links l JOIN entries le ON le.id = l.target_id'
+                    ' WHERE l.entry_id IN ({}) AND l.link_type IN ({})'.format(','.join('?'*len(batch)), ','.join('?'*len(links))),
+                    batch + list(links),
+                )
+                for entry_id, link_type, body in linked:
+                    records[entry_id]['links'][link_type] = json.loads(body)
+        return list(records.values())
+
+    def load(self, entry_type, links=[], filters=[], ids=[], tags={}, limit=100000):
+        """
+        Answer a rolodex_load query from the replica only
+
+        Filters are equality on a dotted key of the data of the entry (type
+        entry_type) or of its linked entry of that type; values are compared
+        as strings.
+
+        outputs:
+            - list of {'entry': ..., 'links': {link_type: entry}} as
+              rolodex_load, in sync order
+        """
+        with self._lock:
+            return self._load(entry_type, links, filters, ids, tags, limit)
+
+    def entries(self, entry_types=None):
+        """
+        Return all stored entries (of entry_types if given), in sync order
+        """
+        with self._lock:
+            if entry_types is None:
+                rows = self._db.execute('SELECT body FROM entries ORDER BY rowid').fetchall()
+            else:
+                entry_types = list(entry_types)
+                rows = self._db.execute(
+                    'SELECT body FROM entries WHERE type IN ({}) ORDER BY rowid'.format(','.join('?'*len(entry_types))), entry_types,
+                ).fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def links(self):
+        """
+        Return all stored links as (entry_id, link_type, target_id)
+        """
+        with self._lock:
+            return self._db.execute('SELECT entry_id, link_type, target_id FROM links').fetchall()
+
+    def get(self, entry_type, links=[], filters=[], ids=[], tags={}, limit=100000, **page_kwargs):
+        """
+        Answer a rolodex_load query, syncing it first if it was never synced
+        (or is older than ttl)
+
+        raises:
+            - LookupError if offline and the query was never synced
+        """
+        synced_at = self.synced_at(entry_type, links, filters, ids, tags, limit)
+        if synced_at is None or (self.ttl is not None and time.time() - synced_at >= self.ttl):
+            if self.offline:
+                if synced_at is None:
+                    raise LookupError(f'{entry_type} query is not in the replica')
+            else:
+                self.sync(entry_type, links, filters, ids, tags, limit, **page_kwargs)
+        return self.load(entry_type, links, filters, ids, tags, limit)
+
+
+_default_replica = None
+_default_replica_lock = threading.Lock()
+
+
+# replica used by rolodex_load
+def get_default_replica():
+    """
+    Return the replica rolodex_load answers from, None (the default) to
+    always ask rolodex
+    """
+    return _default_replica
+
+
+# configure the shared replica
+def configure_replica(path=DEFAULT_REPLICA_PATH, ttl=None, offline=False):
+    """
+    Make rolodex_load answer from a RolodexReplica (see it for the options);
+    path None switches back to always asking rolodex
+    """
+    global _default_replica
+    with _default_replica_lock:
+        if _default_replica is not None:
+            _default_replica.close()
+        _default_replica = None if path is None else RolodexReplica(path, ttl, offline)
+    return _default_replica
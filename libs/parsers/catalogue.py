@@ -0,0 +1,150 @@
+"""
+Header-only catalogue of directories of Square and Olson data files
+
+Only the bytes of the file header (and, for Square files, the probe data) are
+read, so a catalogue of thousands of files can be built without touching the
+waveform data. Results can be cached on disk, keyed by path, size and mtime,
+so that re-scanning an archive only parses new or changed files.
+
+"""
+import concurrent.futures
+import os
+import typing as t
+from pathlib import Path
+
+import pandas as pd
+
+from ..parsers.square_formats import (
+    Cursor,
+    DepthReceptions,
+    Double,
+    FileHeader,
+    Group,
+    Reserved,
+    SquareDataStream,
+    String,
+    _read_prefix,
+)
+
+
+# glob pattern -> file format
+# (Olson files have no fixed extension, catalogue them with an explicit
+# pattern, ie {**DEFAULT_PATTERNS, "*.dat": "olson"})
+DEFAULT_PATTERNS = {
+    "*.lwld": "square",
+}
+
+# columns identifying the version of a file on disk
+KEY_COLUMNS = ["path", "size", "mtime"]
+
+
+def _parse_olson_header(buf: bytes):
+    cursor = Cursor(buf)
+    version = cursor.parse(Double).value
+    return version, cursor.parse(FileHeader)
+
+
+def _flatten(group: Group, prefix: str = "") -> t.Dict:
+    """Flat dict of the scalar fields of a group, strings decoded"""
+    row = {}
+    for attr_name, _type in group._fields:
+        # opaque blocks are not useful in a catalogue
+        if _type in (Reserved, DepthReceptions):
+            continue
+        value = group.contents[attr_name]
+        if _type is String:
+            value = value.decode("utf-8", errors="replace")
+        row[prefix + attr_name] = value
+    return row
+
+
+def read_header_row(path: Path, file_format: str) -> t.Dict:
+    """Catalogue row of one file, parsed from its header bytes only"""
+    with open(path, "rb") as fobj:
+        if file_format == "square":
+            header, probe_data, _ = _read_prefix(fobj, SquareDataStream._parse_header)
+            row = _flatten(header)
+            for i, probe in enumerate(probe_data):
+                row.update(_flatten(probe, prefix=f"probe{i}_"))
+        elif file_format == "olson":
+            version, header = _read_prefix(fobj, _parse_olson_header)
+            row = {"version": version}
+            row.update(_flatten(header))
+        else:
+            raise ValueError(f"Unknown file format {file_format}")
+    return row
+
+
+def _catalogue_row(path: Path, file_format: str, size: int, mtime: int) -> t.Dict:
+    row = {"path": str(path), "size": size, "mtime": mtime, "format": file_format}
+    try:
+        row.update(read_header_row(path, file_format))
+        row["error"] = None
+    except Exception as e:
+        row["error"] = repr(e)
+    return row
+
+
+def build_catalogue(
+    root: Path,
+    patterns: t.Dict[str, str] = DEFAULT_PATTERNS,
+    cache_path: t.Optional[Path] = None,
+    max_workers: int = 8,
+) -> pd.DataFrame:
+    """
+    Scan a directory tree and return one row of header fields per data file
+
+    inputs:
+        - root - directory to search recursively
+        - patterns - glob pattern -> file format ("square" or "olson"); the
+          default only finds Square (*.lwld) files, Olson files need their
+          own pattern
+        - cache_path - optional pickle file of a previous catalogue; only new
+          or changed files are parsed and the cache is updated
+        - max_workers - number of files read in parallel
+    outputs:
+        - catalogue_df with columns:
+            - path, size, mtime (ns), format
+            - the FileHeader fields
+            - probe<i>_<field> for the ProbeData of each probe (Square files)
+            - error - repr of the exception for files that failed to parse
+    """
+    # list the files and their current size/mtime
+    files = {}
+    for pattern, file_format in patterns.items():
+        for path in Path(root).rglob(pattern):
+            stat = os.stat(path)
+            files[str(path)] = (file_format, stat.st_size, stat.st_mtime_ns)
+
+    # reuse cached rows of files that did not change
+    cached_df = None
+    if cache_path is not None and Path(cache_path).exists():
+        cached_df = pd.read_pickle(cache_path)
+        current = pd.DataFrame(
+            [(path, size, mtime) for path, (_, size, mtime) in files.items()],
+            columns=KEY_COLUMNS,
+        )
+        cached_df = cached_df.merge(current, on=KEY_COLUMNS, how="inner")
+        for path in cached_df["path"]:
+            files.pop(path)
+
+    # parse the headers of the remaining files
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        rows = list(
+            pool.map(
+                lambda item: _catalogue_row(item[0], *item[1]),
+                files.items(),
+            )
+        )
+
+    frames = [df for df in (cached_df, pd.DataFrame(rows)) if df is not None and len(df)]
+    if frames:
+        catalogue_df = pd.concat(frames, ignore_index=True)
+        catalogue_df = catalogue_df.sort_values("path", ignore_index=True)
+    else:
+        catalogue_df = pd.DataFrame(columns=KEY_COLUMNS + ["format", "error"])
+
+    if cache_path is not None:
+        catalogue_df.to_pickle(cache_path)
+
+    return catalogue_df
@@ -0,0 +1,275 @@
+"""
+Columnar on-disk cache of parsed SquareData and WinSSS_SW files
+
+A parsed file is written to a directory of `.npy` arrays plus a `meta.json`
+sidecar holding the header, probe, gate and line metadata. The directory is
+named after a content hash of the source file. Reopening memory-maps the
+arrays and rebuilds the reader object without parsing the vendor binary.
+
+The per-waveform header table can also be exported to Arrow/Parquet when
+pyarrow is installed.
+
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import typing as t
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from ..parsers.square_formats import (
+    FileHeader,
+    FullWaveform,
+    Gates,
+    LineHeader,
+    ProbeData,
+    ShortWaveform,
+    SquareData,
+    WaveformIndex,
+    WinSSS_SW,
+    _map_file,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+# bump when the layout of a cache directory changes
+CACHE_VERSION = 1
+
+SQUARE_ARRAYS = (
+    "angles_array",
+    "exits_array",
+    "raw_paut_waveform_data",
+    "probe_numbers_array",
+    "digital_inputs_array",
+    "timestamps_array",
+)
+
+
+def _encode(value):
+    # header contents hold raw bytes for Strings and reserved blocks
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    return value
+
+
+def _dump_group(group) -> t.Dict:
+    return {
+        "length": group.length,
+        "contents": {k: _encode(v) for k, v in group.contents.items()},
+    }
+
+
+def _load_group(cls, data: t.Dict):
+    contents = {k: _decode(v) for k, v in data["contents"].items()}
+    return cls.from_contents(contents, data["length"])
+
+
+def _replace_file(path: Path, write):
+    # write next to path and rename over it, so readers (and other processes
+    # sharing the cache) never see a partly written file
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, "wb") as fobj:
+            write(fobj)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def source_hash(filename: Path, cache_root: Path) -> str:
+    """Content hash of a source file
+
+    Hashes are remembered in `cache_root/hashes.json` by path, size and mtime,
+    so an unchanged file is only read once.
+
+    """
+    stat = os.stat(filename)
+    key = f"{Path(filename).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    index_path = Path(cache_root) / "hashes.json"
+    index = json.loads(index_path.read_text()) if index_path.exists() else {}
+    if key in index:
+        return index[key]
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, "rb") as fobj:
+        for block in iter(lambda: fobj.read(1 << 24), b""):
+            digest.update(block)
+
+    index[key] = digest.hexdigest()
+    Path(cache_root).mkdir(parents=True, exist_ok=True)
+    _replace_file(index_path, lambda fobj: fobj.write(json.dumps(index).encode()))
+    return index[key]
+
+
+def save(reader, directory: Path):
+    """Write a parsed SquareData or WinSSS_SW to a cache directory"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    if isinstance(reader, SquareData):
+        meta = {
+            "type": "SquareData",
+            "header": _dump_group(reader.header),
+            "probe_data": [_dump_group(probe) for probe in reader.probe_data],
+            "gates": _dump_group(reader.gates),
+        }
+        arrays = {name: getattr(reader, name) for name in SQUARE_ARRAYS}
+    elif isinstance(reader, WinSSS_SW):
+        if reader.samples is None:
+            raise ValueError("Lazily loaded WinSSS_SW files cannot be cached")
+        meta = {
+            "type": "WinSSS_SW",
+            "version": reader.version,
+            "header": _dump_group(reader.header),
+            "lines": [_dump_group(line) for line in reader.lines],
+        }
+        arrays = {
+            "waveforms": reader.waveforms,
+            "samples": reader.samples,
+            "end_bytes": np.frombuffer(reader.end_bytes, dtype=np.uint8),
+            "line_offsets": reader.index.line_offsets,
+            "wave_offsets": reader.index.wave_offsets,
+            "line_starts": reader.index.line_starts,
+        }
+    else:
+        raise TypeError(f"Cannot cache {type(reader).__name__}")
+
+    for name, array in arrays.items():
+        _replace_file(directory / f"{name}.npy", lambda fobj: np.save(fobj, array))
+
+    # the sidecar is written last: its presence marks a complete entry
+    meta["cache_version"] = CACHE_VERSION
+    _replace_file(directory / "meta.json", lambda fobj: fobj.write(json.dumps(meta).encode()))
+
+
+def load(directory: Path, source: t.Optional[Path] = None):
+    """Reopen a cache directory with its arrays memory-mapped
+
+    Returns None if the directory does not hold a complete, current entry.
+    For WinSSS_SW files the source is mapped too (if given), so that the
+    per-pulse `LineHeader.waves` objects stay available; without it only the
+    `waveforms` and `samples` arrays are, and `waves` raises ValueError.
+
+    """
+    directory = Path(directory)
+    meta_path = directory / "meta.json"
+    if not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text())
+    if meta.get("cache_version") != CACHE_VERSION:
+        return None
+
+    def array(name):
+        return np.load(directory / f"{name}.npy", mmap_mode="r")
+
+    if meta["type"] == "SquareData":
+        reader = SquareData.__new__(SquareData)
+        reader.header = _load_group(FileHeader, meta["header"])
+        reader.probe_data = [_load_group(ProbeData, probe) for probe in meta["probe_data"]]
+        reader.gates = _load_group(Gates, meta["gates"])
+        for name in SQUARE_ARRAYS:
+            setattr(reader, name, array(name))
+        return reader
+
+    reader = WinSSS_SW.__new__(WinSSS_SW)
+    reader.version = meta["version"]
+    reader.header = _load_group(FileHeader, meta["header"])
+    reader.waveforms = array("waveforms")
+    reader.samples = array("samples")
+    reader.end_bytes = memoryview(array("end_bytes"))
+    reader.index = WaveformIndex(
+        array("line_offsets"),
+        array("wave_offsets"),
+        array("line_starts"),
+        reader.samples.shape[1],
+        0,
+    )
+    reader._view = memoryview(_map_file(source)) if source is not None else None
+    reader._waveform_type = FullWaveform if reader.version >= 1.7 else ShortWaveform
+    reader._header_dtype = reader.waveforms.dtype
+
+    reader.lines = []
+    for i, line_meta in enumerate(meta["lines"]):
+        line = _load_group(LineHeader, line_meta)
+        line.wave_slice = slice(
+            int(reader.index.line_starts[i]), int(reader.index.line_starts[i + 1])
+        )
+        line.wave_offsets = reader.index.wave_offsets[line.wave_slice]
+        line.waveforms = reader.waveforms[line.wave_slice]
+        line.samples = reader.samples[line.wave_slice]
+        line._view = reader._view
+        line._waveform_type = reader._waveform_type
+        reader.lines.append(line)
+    return reader
+
+
+def open_cached(filename: Path, cache_root: Path, reader_cls=SquareData):
+    """Open a data file through the cache
+
+    inputs:
+        - filename - SquareData or WinSSS_SW source file
+        - cache_root - directory holding one sub-directory per content hash
+        - reader_cls - SquareData or WinSSS_SW, used on a cache miss
+    outputs:
+        - the reader object, with its arrays memory-mapped from the cache
+    """
+    directory = Path(cache_root) / source_hash(filename, cache_root)
+    reader = load(directory, filename)
+    if reader is None:
+        save(reader_cls.from_file(filename), directory)
+        reader = load(directory, filename)
+    return reader
+
+
+def waveform_table(reader) -> pd.DataFrame:
+    """One row per waveform (WinSSS_SW) or per A-scan (SquareData)"""
+    if isinstance(reader, WinSSS_SW):
+        table = pd.DataFrame(
+            {name: np.asarray(reader.waveforms[name]) for name in reader.waveforms.dtype.names}
+        )
+        line_starts = np.asarray(reader.index.line_starts)
+        table.insert(0, "line", np.repeat(np.arange(len(line_starts) - 1), np.diff(line_starts)))
+        return table
+
+    encoder_size, num_cycles = reader.raw_paut_waveform_data.shape[:2]
+    return pd.DataFrame(
+        {
+            "encoder": np.repeat(np.arange(encoder_size), num_cycles),
+            "cycle": np.tile(np.arange(num_cycles), encoder_size),
+            "probe_number": np.asarray(reader.probe_numbers_array),
+            "digital_input": np.asarray(reader.digital_inputs_array),
+            "timestamp": np.repeat(np.asarray(reader.timestamps_array), num_cycles),
+            "angle": np.tile(np.asarray(reader.angles_array), encoder_size),
+            "exit": np.tile(np.asarray(reader.exits_array), encoder_size),
+        }
+    )
+
+
+def to_arrow(reader) -> "pa.Table":
+    """The waveform table as an Arrow table (requires pyarrow)"""
+    if pa is None:
+        raise ImportError("pyarrow is required for Arrow export")
+    return pa.Table.from_pandas(waveform_table(reader), preserve_index=False)
+
+
+def export_parquet(reader, path: Path):
+    """Write the waveform table to a Parquet file (requires pyarrow)"""
+    pq.write_table(to_arrow(reader), path)
@@ -15,8 +15,12 @@ Reference:
 - https://numpy.org/doc/stable/user/basics.rec.html
 
 """
+import mmap
 import pprint
+import struct
 import typing as t
+from collections import OrderedDict
+from collections.abc import Sequence
 from pathlib import Path
 
 import dpkt
@@ -33,22 +37,287 @@ class CompatibilityError(Exception):
     pass
 
 
+def _map_file(filename: Path) -> mmap.mmap:
+    """Read-only memory map of a whole file
+
+    The map outlives the file object; numpy arrays created from it keep it
+    alive for as long as they are referenced.
+
+    """
+    with open(filename, "rb") as fobj:
+        return mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _read_prefix(fobj: t.BinaryIO, parse: t.Callable, size: int = 4096):
+    """Parse the start of a file, reading only as many bytes as `parse` needs
+
+    `parse` is retried with a prefix twice as long each time it raises
+    `dpkt.NeedData`, until the whole file has been read.
+
+    """
+    while True:
+        fobj.seek(0)
+        buf = fobj.read(size)
+        try:
+            return parse(buf)
+        except dpkt.NeedData:
+            if len(buf) < size:
+                raise
+            size *= 2
+
+
+class Cursor:
+    """Offset cursor over a binary buffer
+
+    Walks the buffer through a memoryview so that consuming n bytes only moves
+    an offset. Slicing a `bytes` object (`buf = buf[n:]`) copies the whole
+    remainder instead, which makes parsing quadratic in file size.
+
+    """
+
+    view: memoryview
+    offset: int
+
+    def __init__(self, buf, offset: int = 0):
+        self.view = memoryview(buf)
+        self.offset = offset
+
+    def remaining(self) -> memoryview:
+        return self.view[self.offset :]
+
+    def skip(self, n: int):
+        self.offset += n
+
+    def parse(self, _type):
+        """Parse one Entry or Group at the cursor and consume its bytes"""
+        entry = _type(self.remaining())
+        self.offset += len(entry)
+        return entry
+
+    def array(self, dtype, count: int) -> np.ndarray:
+        """Numpy view of `count` items at the cursor, consuming their bytes"""
+        array = np.frombuffer(self.view, dtype=dtype, count=count, offset=self.offset)
+        self.offset += array.nbytes
+        return array
+
+
+_INT32 = struct.Struct("<i")
+
+# numpy equivalents of the struct format characters used by the entries
+_NUMPY_FORMATS = {"d": "<f8", "i": "<i4", "q": "<i8", "?": "?"}
+
+
+def waveform_dtype(Waveform) -> np.dtype:
+    """Packed structured dtype matching the fixed header of a waveform record"""
+    return np.dtype([(name, _NUMPY_FORMATS[fmt]) for name, fmt, _ in Waveform.__hdr__])
+
+
+def _index_waveforms(view: memoryview, offset: int, count: int, Waveform):
+    """First pass over `count` consecutive waveform records
+
+    Only `Wave._length` and `Mask.points` vary in size, so reading those two
+    integers per record is enough to find where every record starts.
+
+    Returns (record offsets, samples per record, offset after the last record)
+
+    """
+    hdr_len = Waveform.__hdr_len__
+    offsets = np.empty(count, dtype=np.int64)
+    sample_counts = np.empty(count, dtype=np.int64)
+    for j in range(count):
+        offsets[j] = offset
+        (length,) = _INT32.unpack_from(view, offset + hdr_len)
+        mask_offset = offset + hdr_len + Wave.__hdr_len__ + 4 * length
+        (points,) = _INT32.unpack_from(view, mask_offset)
+        sample_counts[j] = length
+        offset = mask_offset + Mask.__hdr_len__ + MaskP.__hdr_len__ * points
+    return offsets, sample_counts, offset
+
+
+def _gather(view: memoryview, offsets: np.ndarray, dtype: np.dtype, out: np.ndarray):
+    """Copy one `dtype` item found at each of `offsets` into `out`
+
+    Records of a scan line are usually evenly spaced, in which case the copy is
+    a single strided numpy assignment.
+
+    """
+    if len(offsets) == 0:
+        return
+    stride = int(offsets[1] - offsets[0]) if len(offsets) > 1 else dtype.itemsize
+    if stride > 0 and (np.diff(offsets) == stride).all():
+        out[:] = np.ndarray(
+            shape=len(offsets),
+            dtype=dtype,
+            buffer=view,
+            offset=int(offsets[0]),
+            strides=(stride,),
+        )
+        return
+    for j, offset in enumerate(offsets):
+        out[j] = np.frombuffer(view, dtype=dtype, count=1, offset=int(offset))[0]
+
+
+class WaveformIndex:
+    """Byte offsets of every scan line and waveform record of a WinSSS_SW file
+
+    Built by one pass over the file; it can be saved next to the file so that
+    later opens skip that pass.
+
+    """
+
+    line_offsets: np.ndarray
+    wave_offsets: np.ndarray
+    # index into wave_offsets where each line starts, plus the total at the end
+    line_starts: np.ndarray
+    n_samples: int
+    end_offset: int
+
+    def __init__(self, line_offsets, wave_offsets, line_starts, n_samples, end_offset):
+        self.line_offsets = line_offsets
+        self.wave_offsets = wave_offsets
+        self.line_starts = line_starts
+        self.n_samples = int(n_samples)
+        self.end_offset = int(end_offset)
+
+    @classmethod
+    def build(cls, cursor: Cursor, line_count: int, Waveform) -> "WaveformIndex":
+        """Index `line_count` scan lines starting at the cursor"""
+        line_offsets = np.empty(line_count, dtype=np.int64)
+        line_starts = np.zeros(line_count + 1, dtype=np.int64)
+        wave_offsets = []
+        sample_counts = []
+        for i in tqdm.trange(line_count, desc="indexing lines", leave=False):
+            line_offsets[i] = cursor.offset
+            line = cursor.parse(LineHeader)
+
+            # Some number of waveforms in this line
+            wave_count = line.contents["numWaveforms"]
+            line_wave_offsets, line_sample_counts, cursor.offset = _index_waveforms(
+                cursor.view, cursor.offset, wave_count, Waveform
+            )
+            line_starts[i + 1] = line_starts[i] + wave_count
+            wave_offsets.append(line_wave_offsets)
+            sample_counts.append(line_sample_counts)
+
+        n_samples = np.unique(np.concatenate(sample_counts)) if sample_counts else []
+        if len(n_samples) > 1:
+            raise CompatibilityError(
+                f"Expected one sample count per file. Found {n_samples.tolist()}."
+            )
+        return cls(
+            line_offsets,
+            np.concatenate(wave_offsets) if wave_offsets else np.empty(0, dtype=np.int64),
+            line_starts,
+            n_samples[0] if len(n_samples) else 0,
+            cursor.offset,
+        )
+
+    def save(self, filename: Path, source: Path):
+        """Save the index, stamped with the size and mtime of the source file"""
+        stat = Path(source).stat()
+        with open(filename, "wb") as fobj:
+            np.savez(
+                fobj,
+                line_offsets=self.line_offsets,
+                wave_offsets=self.wave_offsets,
+                line_starts=self.line_starts,
+                n_samples=self.n_samples,
+                end_offset=self.end_offset,
+                source_size=stat.st_size,
+                source_mtime=stat.st_mtime_ns,
+            )
+
+    @classmethod
+    def load(cls, filename: Path, source: Path) -> t.Optional["WaveformIndex"]:
+        """Load a saved index, or None if it is missing or the source changed"""
+        try:
+            saved = np.load(filename)
+        except (OSError, ValueError):
+            return None
+        with saved:
+            stat = Path(source).stat()
+            if (
+                int(saved["source_size"]) != stat.st_size
+                or int(saved["source_mtime"]) != stat.st_mtime_ns
+            ):
+                return None
+            return cls(
+                saved["line_offsets"],
+                saved["wave_offsets"],
+                saved["line_starts"],
+                saved["n_samples"],
+                saved["end_offset"],
+            )
+
+
+class LazyLines(Sequence):
+    """Scan lines of a WinSSS_SW file, decoded on first access
+
+    The most recently used lines are kept in a bounded LRU cache.
+
+    """
+
+    def __init__(self, reader: "WinSSS_SW", cache_size: int):
+        self._reader = reader
+        self._cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def __len__(self):
+        return len(self._reader.index.line_offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        # normalises negative indices and raises IndexError when out of range
+        i = range(len(self))[i]
+
+        line = self._cache.get(i)
+        if line is None:
+            line = self._reader._decode_line(i)
+            self._cache[i] = line
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(i)
+        return line
+
+
 class WinSSS_SW:
     """Reader for the Olson File Format
 
     Strictly for version > 1.4
 
+    With `lazy=True` only the file header and the record index are read up
+    front; scan lines are decoded when they are first accessed.
+
     """
 
     version: float
     header: "FileHeader"
-    lines: t.List["LineHeader"]
+    index: WaveformIndex
+    lines: t.Sequence["LineHeader"]
 
     @classmethod
-    def from_file(cls, filename: Path):
-        with open(filename, "rb") as fobj:
-            file_contents = fobj.read()
-        return cls(file_contents)
+    def from_file(cls, filename: Path, lazy: bool = False, cache_size: int = 16):
+        buf = _map_file(filename)
+        if not lazy:
+            return cls(buf)
+
+        # reuse the index saved next to the file, if it is still valid
+        index_path = cls.index_path(filename)
+        index = WaveformIndex.load(index_path, filename)
+        reader = cls(buf, lazy=True, index=index, cache_size=cache_size)
+        if index is None:
+            try:
+                reader.index.save(index_path, filename)
+            except OSError:
+                # read-only location, the index is rebuilt next time
+                pass
+        return reader
+
+    @staticmethod
+    def index_path(filename: Path) -> Path:
+        return Path(f"{filename}.idx.npz")
 
     def _check_version(self, version):
         # Check version
@@ -68,78 +337,127 @@ class WinSSS_SW:
         # P-wave velocity Units of ft/s
         return float(self.header.contents["velToolStripTextBox"])
 
-    def __init__(self, buf: bytes):
+    def __init__(
+        self,
+        buf: bytes,
+        lazy: bool = False,
+        index: t.Optional[WaveformIndex] = None,
+        cache_size: int = 16,
+    ):
+        cursor = Cursor(buf)
+
         # File Version "as written"
-        _version = Double(buf)
-        buf = buf[len(_version) :]
-        version = _version.value
+        version = cursor.parse(Double).value
         self._check_version(version)
         self.version = version
 
         Waveform = FullWaveform if version >= 1.7 else ShortWaveform
+        self._view = cursor.view
+        self._waveform_type = Waveform
+        self._header_dtype = waveform_dtype(Waveform)
 
         # file header
-        header = FileHeader(buf)
-        buf = buf[len(header) :]
-        self.header = header
-
-        # Some number of scan lines
-        line_count = self.header.contents["numLines"]
-        self.lines = []
-        for i in tqdm.trange(line_count, desc="parsing lines", leave=False):
-            line = LineHeader(buf)
-            buf = buf[len(line) :]
-            self.lines.append(line)
+        self.header = cursor.parse(FileHeader)
 
-            # Some number of waveforms in this line
-            wave_count = line.contents["numWaveforms"]
-            waves = []
-            for j in tqdm.trange(wave_count, desc="parsing waves", leave=False):
-                wave = Waveform(buf)
-                buf = buf[len(wave) :]
-                waves.append(wave)
-
-            line.waves = waves
+        # Pass 1: index the scan lines and the waveform records in each one
+        if index is None:
+            index = WaveformIndex.build(cursor, self.header.contents["numLines"], Waveform)
+        self.index = index
 
         # I think the rest is a color palette. Not particularly interesting to
         # us.
-        self.end_bytes = buf
+        self.end_bytes = cursor.view[index.end_offset :]
+
+        if lazy:
+            self.waveforms = None
+            self.samples = None
+            self.lines = LazyLines(self, cache_size)
+            return
+
+        # Pass 2: decode all the waveform headers into one structured array and
+        # all the samples into one (n_waves, n_samples) array
+        wave_count = len(index.wave_offsets)
+        self.waveforms = np.empty(wave_count, dtype=self._header_dtype)
+        self.samples = np.empty((wave_count, index.n_samples), dtype=np.int32)
+        self.lines = [
+            self._decode_line(i, self.waveforms, self.samples)
+            for i in range(len(index.line_offsets))
+        ]
+
+    def _decode_line(self, i: int, waveforms=None, samples=None) -> "LineHeader":
+        """Decode scan line `i` and its waveform records
+
+        The records are written into the rows of `waveforms`/`samples` that
+        belong to the line when those are given, or into new arrays otherwise.
 
-    def signals(self):
+        """
+        index = self.index
+        line = LineHeader(self._view[index.line_offsets[i] :])
+        line.wave_slice = slice(int(index.line_starts[i]), int(index.line_starts[i + 1]))
+        line.wave_offsets = index.wave_offsets[line.wave_slice]
+        line._view = self._view
+        line._waveform_type = self._waveform_type
+
+        if waveforms is None:
+            line.waveforms = np.empty(len(line.wave_offsets), dtype=self._header_dtype)
+            line.samples = np.empty((len(line.wave_offsets), index.n_samples), dtype=np.int32)
+        else:
+            line.waveforms = waveforms[line.wave_slice]
+            line.samples = samples[line.wave_slice]
+
+        _gather(self._view, line.wave_offsets, self._header_dtype, line.waveforms)
+        _gather(
+            self._view,
+            line.wave_offsets + self._waveform_type.__hdr_len__ + Wave.__hdr_len__,
+            np.dtype(("<i4", (index.n_samples,))),
+            line.samples,
+        )
+        return line
+
+    def signals(self, scan_numbers: t.Optional[t.Iterable[int]] = None):
         """Returns a list of Numpy arrays of scan line signals
 
-        The length of the list is the number of scan lines.
+        The length of the list is the number of scan lines, or the length of
+        `scan_numbers` when only some scans are requested.
         The array for each scan line has shape: (pulse count, 2, sample count)
             pulse count - the number of excitation pulses recorded in this scan line
             2 - left and right transducer wheels
             sample count - the length in samples of each amplitude signal.
 
+        When the whole file is decoded the arrays are views of `samples`.
+
         """
+        if scan_numbers is None:
+            scan_numbers = range(len(self.lines) // 2)
+
         # Reshape the parsed data:
         scan_lines = []
         location_data = []
-        for scan_number in range(len(self.lines) // 2):
-            left_line = self.lines[2 * scan_number]
-            right_line = self.lines[(2 * scan_number) + 1]
-
+        for scan_number in scan_numbers:
+            first_line = self.lines[2 * scan_number]
+            second_line = self.lines[(2 * scan_number) + 1]
+
+            pulse_count = len(first_line.waveforms)
+            if self.samples is not None:
+                # the two lines of a scan are adjacent in `samples`
+                cube = self.samples[first_line.wave_slice.start : second_line.wave_slice.stop]
+                # explicit sample count: -1 can not be resolved for lines without waves
+                cube = cube.reshape(2, pulse_count, self.samples.shape[1]).transpose(1, 0, 2)
+            else:
+                cube = np.stack([first_line.samples, second_line.samples], axis=1)
+
+            left_line, right_line = first_line, second_line
             if left_line.contents["wheel"] == "R":
                 left_line, right_line = right_line, left_line
+                cube = cube[:, ::-1]
 
-            pulse_count = len(left_line.waves)
-            cube = np.stack(
-                [
-                    np.array([w.wave.array for w in left_line.waves]),
-                    np.array([w.wave.array for w in right_line.waves]),
-                ],
-                axis=1,
-            )
             location = np.zeros((pulse_count, 2, 2), dtype=np.float32)
             left_x = left_line.contents["distance"]
-            left_y = [w.distance for w in left_line.waves]
+            left_y = left_line.waveforms["distance"]
             location[:, 0, 0] = left_x
             location[:, 0, 1] = left_y
             right_x = right_line.contents["distance"]
-            right_y = [w.distance for w in right_line.waves]
+            right_y = right_line.waveforms["distance"]
             location[:, 1, 0] = right_x
             location[:, 1, 1] = right_y
 
@@ -158,11 +476,9 @@ class SquareData:
 #     header: "FileHeader"
 #     lines: t.List["LineHeader"]
 
-#     @classmethod
-#     def from_file(cls, filename: Path):
-#         with open(filename, "rb") as fobj:
-#             file_contents = fobj.read()
-#         return cls(file_contents)
+    @classmethod
+    def from_file(cls, filename: Path):
+        return cls(_map_file(filename))
 
 #     def _check_version(self, version):
 #         # Check version
@@ -182,72 +498,197 @@ class SquareData:
 #         # P-wave velocity Units of ft/s
 #         return float(self.header.contents["velToolStripTextBox"])
 
+    @staticmethod
+    def body_dtype(header_contents: t.Dict) -> np.dtype:
+        """Structured dtype of the block following the probe data
+
+        Field offsets and `itemsize` give the exact byte position of each array
+        in the file, relative to the end of the probe data.
+
+        """
+        num_cycles = header_contents["num_cycles"]
+        encoder_size = header_contents["encoder_size"]
+        num_points = header_contents["num_points"]
+        return np.dtype(
+            [
+                ("reserved2", np.uint8, (192,)),
+                ("angles_array", np.double, (num_cycles,)),
+                ("exits_array", np.double, (num_cycles,)),
+                ("raw_paut_waveform_data", np.int8, (encoder_size, num_cycles, num_points)),
+                ("probe_numbers_array", np.int32, (encoder_size * num_cycles,)),
+                ("digital_inputs_array", np.int32, (encoder_size * num_cycles,)),
+                ("timestamps_array", np.double, (encoder_size,)),
+                ("reserved3", np.uint8, (1,)),
+            ]
+        )
+
     def __init__(self, buf: bytes):
+        cursor = Cursor(buf)
+
         # file header
-        header = FileHeader(buf)
-        buf = buf[len(header) :]
+        header = cursor.parse(FileHeader)
         self.header = header
 
         # get ref data
         num_selected_probes = header.contents["num_selected_probes"]
-        num_cycles = header.contents["num_cycles"]
-        encoder_size = header.contents["encoder_size"]
-        num_points = header.contents["num_points"]
         
+        # ProbeData has no variable length fields, so its compiled size is exact
+        probe_size = ProbeData.layout().size
+        if probe_size!=482:
+            print('ERROR: probe_data len {} != 482'.format(probe_size))
+
         # iterate through probes
         self.probe_data = []
         for probe_i in range(num_selected_probes):
-            probe_data_i = ProbeData(buf)
-            if len(probe_data_i)!=482:
-                print('ERROR: probe_data len {} != 482'.format(len(probe_data_i)))
-            buf = buf[len(probe_data_i) :]
-            self.probe_data.append(probe_data_i)
+            self.probe_data.append(cursor.parse(ProbeData))
             
-        # skip reserved2 block
-        buf = buf[192 :]
-        
-        # get angles array
-        self.angles_array = np.frombuffer(buf, dtype=np.double, count=num_cycles)
-        buf = buf[8*num_cycles : ]
-        
-        # get exits array
-        self.exits_array = np.frombuffer(buf, dtype=np.double, count=num_cycles)
-        buf = buf[8*num_cycles : ]
-        
-        # get Raw PAUT waveform data
-        self.raw_paut_waveform_data = np.frombuffer(buf, dtype=np.int8, count=encoder_size*num_cycles*num_points)
-        self.raw_paut_waveform_data.shape = (encoder_size, num_cycles, num_points)
-        buf = buf[len(self.raw_paut_waveform_data) : ]
-        
-        # get probe_numbers array
-        self.probe_numbers_array = np.frombuffer(buf, dtype=np.int32, count=encoder_size*num_cycles)
-        buf = buf[len(self.probe_numbers_array) : ]
-        
-        # get digital_inputs array
-        self.digital_inputs_array = np.frombuffer(buf, dtype=np.int32, count=encoder_size*num_cycles)
-        buf = buf[len(self.digital_inputs_array) : ]
-        
-        # get timestamps array
-        self.timestamps_array = np.frombuffer(buf, dtype=np.double, count=encoder_size)
-        buf = buf[len(self.timestamps_array) : ]
-        
-        # skip reserved3 block
-        buf = buf[1 :]
+        # get the angles, exits, raw PAUT waveform data, probe_numbers,
+        # digital_inputs and timestamps arrays (and skip the reserved blocks)
+        # as views of one structured block
+        body = cursor.array(self.body_dtype(header.contents), 1)
+        self.angles_array = body["angles_array"][0]
+        self.exits_array = body["exits_array"][0]
+        self.raw_paut_waveform_data = body["raw_paut_waveform_data"][0]
+        self.probe_numbers_array = body["probe_numbers_array"][0]
+        self.digital_inputs_array = body["digital_inputs_array"][0]
+        self.timestamps_array = body["timestamps_array"][0]
         
         # get gates
-        gates_data = Gates(buf)
+        gates_data = cursor.parse(Gates)
         self.gates = gates_data
         
 
         
 
 
+class SquareChunk:
+    """Aligned slices of the SquareData arrays for a run of encoder positions
+
+    The arrays have the same layout as the SquareData attributes of the same
+    name, restricted to encoder positions `encoder_start` to `encoder_stop`.
+
+    """
+
+    encoder_start: int
+    encoder_stop: int
+    raw_paut_waveform_data: np.ndarray
+    probe_numbers_array: np.ndarray
+    digital_inputs_array: np.ndarray
+    timestamps_array: np.ndarray
+
+    def __len__(self):
+        return self.encoder_stop - self.encoder_start
+
+
+class SquareDataStream:
+    """Streaming reader for the Square Data File Format
+
+    Only the header, probe data, angles, exits and gates are read up front.
+    Iterating yields `SquareChunk`s of `chunk_size` encoder positions, read
+    from offsets computed from the header, so memory use does not depend on
+    the length of the scan.
+
+    """
+
+    header: "FileHeader"
+    probe_data: t.List["ProbeData"]
+    angles_array: np.ndarray
+    exits_array: np.ndarray
+    gates: "Gates"
+
+    def __init__(self, filename: Path, chunk_size: int = 256):
+        self.filename = filename
+        self.chunk_size = chunk_size
+
+        with open(filename, "rb") as fobj:
+            self.header, self.probe_data, body_offset = _read_prefix(
+                fobj, self._parse_header
+            )
+            self.body_dtype = SquareData.body_dtype(self.header.contents)
+
+            # absolute offset of each array section
+            self.offsets = {
+                name: body_offset + offset
+                for name, (_, offset) in self.body_dtype.fields.items()
+            }
+            self.angles_array = self._read(fobj, "angles_array", np.double, 0, self.num_cycles)
+            self.exits_array = self._read(fobj, "exits_array", np.double, 0, self.num_cycles)
+
+            fobj.seek(body_offset + self.body_dtype.itemsize)
+            self.gates = Gates(fobj.read(Gates.layout().size))
+
+    @staticmethod
+    def _parse_header(buf: bytes):
+        cursor = Cursor(buf)
+        header = cursor.parse(FileHeader)
+        probe_data = [
+            cursor.parse(ProbeData) for _ in range(header.contents["num_selected_probes"])
+        ]
+        return header, probe_data, cursor.offset
+
+    @property
+    def encoder_size(self) -> int:
+        return self.header.contents["encoder_size"]
+
+    @property
+    def num_cycles(self) -> int:
+        return self.header.contents["num_cycles"]
+
+    @property
+    def num_points(self) -> int:
+        return self.header.contents["num_points"]
+
+    def _read(self, fobj, name: str, dtype, start: int, count: int) -> np.ndarray:
+        """Read `count` items of array section `name`, starting at item `start`"""
+        dtype = np.dtype(dtype)
+        fobj.seek(self.offsets[name] + start * dtype.itemsize)
+        array = np.fromfile(fobj, dtype=dtype, count=count)
+        if len(array) != count:
+            raise dpkt.NeedData(f"{name}: got {len(array)} items, {count} needed")
+        return array
+
+    def __len__(self):
+        # number of chunks
+        return -(-self.encoder_size // self.chunk_size)
+
+    def __iter__(self) -> t.Iterator[SquareChunk]:
+        num_cycles = self.num_cycles
+        num_points = self.num_points
+        with open(self.filename, "rb") as fobj:
+            for start in range(0, self.encoder_size, self.chunk_size):
+                stop = min(start + self.chunk_size, self.encoder_size)
+                n = stop - start
+
+                chunk = SquareChunk()
+                chunk.encoder_start = start
+                chunk.encoder_stop = stop
+                chunk.raw_paut_waveform_data = self._read(
+                    fobj,
+                    "raw_paut_waveform_data",
+                    np.int8,
+                    start * num_cycles * num_points,
+                    n * num_cycles * num_points,
+                ).reshape(n, num_cycles, num_points)
+                chunk.probe_numbers_array = self._read(
+                    fobj, "probe_numbers_array", np.int32, start * num_cycles, n * num_cycles
+                )
+                chunk.digital_inputs_array = self._read(
+                    fobj, "digital_inputs_array", np.int32, start * num_cycles, n * num_cycles
+                )
+                chunk.timestamps_array = self._read(fobj, "timestamps_array", np.double, start, n)
+                yield chunk
+
+
 # WinSSS-SW
 class Entry(dpkt.Packet):
     """All serialized values use little-endian or machine byte ordering."""
 
     __byte_order__ = "<"  # little-endian
 
+    # Fixed-size entries can be merged into one struct by `Layout`. Entries
+    # whose length depends on their contents must set this to False.
+    fixed_size = True
+
     def unpack(self, buf):
         super().unpack(buf)
         self.data = b""
@@ -278,11 +719,14 @@ class String(Entry):
         # ("pre", "H", 0),
         ("len", "B", 0),
     )
+    fixed_size = False
 
     def unpack(self, buf):
         super().unpack(buf)
-        buf = buf[self.__hdr_len__ :]
-        self.value = buf[: self.len]
+        if len(buf) < self.__hdr_len__ + self.len:
+            raise dpkt.NeedData(f"got {len(buf)}, {self.__hdr_len__ + self.len} needed")
+        # copy out the (short) string so it does not pin the parent buffer
+        self.value = bytes(buf[self.__hdr_len__ : self.__hdr_len__ + self.len])
         self.data = b""
 
     def __len__(self):
@@ -319,12 +763,75 @@ class DepthReceptions(Entry):
 
 
 
+class Layout:
+    """Compiled parsing plan for the fields of a Group
+
+    Each run of consecutive fixed-size fields is merged into a single
+    `struct.Struct`, so it is unpacked in one call without building a dpkt
+    Packet per field. Variable length entries (Strings) are still parsed one at
+    a time in between the runs.
+
+    """
+
+    segments: t.List[t.Tuple[t.Any, t.Any]]
+    min_size: int
+    size: t.Optional[int]
+
+    def __init__(self, fields: t.Tuple[t.Tuple[str, t.Any], ...]):
+        self.segments = []
+        self.min_size = 0
+        variable = False
+
+        run = []
+        for attr_name, _type in fields + ((None, None),):
+            if _type is not None and _type.fixed_size:
+                run.append((attr_name, _type))
+                continue
+
+            # close the current run of fixed-size fields
+            if run:
+                # fixed-size entries hold a single `value` field
+                fmt = "<" + "".join(_type.__hdr__[0][1] for _, _type in run)
+                packer = struct.Struct(fmt)
+                self.segments.append((tuple(name for name, _ in run), packer))
+                self.min_size += packer.size
+                run = []
+
+            if _type is not None:
+                self.segments.append((attr_name, _type))
+                self.min_size += _type.__hdr_len__
+                variable = True
+
+        # exact byte count, if it does not depend on the contents
+        self.size = None if variable else self.min_size
+
+    def unpack(self, buf) -> t.Tuple[t.Dict, int]:
+        """Returns the parsed contents and the number of bytes consumed"""
+        view = memoryview(buf)
+        contents = {}
+        offset = 0
+        for names, packer in self.segments:
+            if isinstance(packer, struct.Struct):
+                if len(view) - offset < packer.size:
+                    raise dpkt.NeedData(
+                        f"got {len(view) - offset}, {packer.size} needed at least"
+                    )
+                contents.update(zip(names, packer.unpack_from(view, offset)))
+                offset += packer.size
+            else:
+                entry = packer(view[offset:])
+                contents[names] = entry.value
+                offset += len(entry)
+        return contents, offset
+
+
 class Group:
     """Logical grouping of fields
 
     This differs from dpkt unpacking in that we have to parse each field
     individual because some fields (Strings) are unknown in length so the group
-    cannot be parsed in one big block.
+    cannot be parsed in one big block. The fixed-size runs in between are
+    compiled into a `Layout` once per class.
 
     """
 
@@ -335,17 +842,24 @@ class Group:
     length: int
 
     def __init__(self, buf: bytes):
-        # Parse the fields into the contents
-        self.contents = {}
-        # Keep track of total length of the binary data consumed
-        self.length = 0
-        for attr_name, _type in self._fields:
-            # parse and consume one entry from the stream
-            entry = _type(buf)
-            consumed = len(entry)
-            buf = buf[consumed:]
-            self.contents[attr_name] = entry.value
-            self.length += consumed
+        # Parse the fields into the contents and keep track of total length of
+        # the binary data consumed
+        self.contents, self.length = self.layout().unpack(buf)
+
+    @classmethod
+    def from_contents(cls, contents: t.Dict, length: int) -> "Group":
+        """Rebuild a parsed group without the binary data, e.g. from a cache"""
+        group = cls.__new__(cls)
+        group.contents = dict(contents)
+        group.length = length
+        return group
+
+    @classmethod
+    def layout(cls) -> Layout:
+        # compiled lazily, once per subclass
+        if "_layout" not in cls.__dict__:
+            cls._layout = Layout(cls._fields)
+        return cls._layout
 
     def __len__(self):
         return self.length
@@ -473,7 +987,25 @@ class LineHeader(Group):
         ("numWaveforms", Int32),
     )
 
-    waves: t.List["Waveform"]
+    # set by WinSSS_SW once the line's waveform records are decoded
+    wave_offsets: np.ndarray
+    wave_slice: slice
+    waveforms: np.ndarray
+    samples: np.ndarray
+
+    @property
+    def waves(self) -> t.List["Waveform"]:
+        """Per-pulse waveform objects, including the mask points
+
+        Built on demand from the record offsets; the bulk data is already
+        available as `waveforms` and `samples`.
+
+        """
+        if self._view is None:
+            raise ValueError(
+                "waves needs the source file, reopen the cache with columnar.load(directory, source)"
+            )
+        return [self._waveform_type(self._view[offset:]) for offset in self.wave_offsets]
 
 
 class ShortWaveform(Entry):
@@ -491,17 +1023,17 @@ class ShortWaveform(Entry):
         ("delaminationFlag", "?", 0),
     )
 
+    fixed_size = False
+
     def unpack(self, buf: bytes):
         super().unpack(buf)
         self.data = b""
-        buf = buf[self.__hdr_len__ :]
+        cursor = Cursor(buf, self.__hdr_len__)
 
-        self.wave = Wave(buf)
-        buf = buf[len(self.wave) :]
+        self.wave = cursor.parse(Wave)
 
         # a few mask points
-        self.mask = Mask(buf)
-        buf = buf[len(self.mask) :]
+        self.mask = cursor.parse(Mask)
 
     def __len__(self):
         return self.__hdr_len__ + len(self.wave) + len(self.mask)
@@ -532,17 +1064,17 @@ class FullWaveform(Entry):
         ("delaminationFlag", "?", 0),
     )
 
+    fixed_size = False
+
     def unpack(self, buf: bytes):
         super().unpack(buf)
         self.data = b""
-        buf = buf[self.__hdr_len__ :]
+        cursor = Cursor(buf, self.__hdr_len__)
 
-        self.wave = Wave(buf)
-        buf = buf[len(self.wave) :]
+        self.wave = cursor.parse(Wave)
 
         # a few mask points
-        self.mask = Mask(buf)
-        buf = buf[len(self.mask) :]
+        self.mask = cursor.parse(Mask)
 
     def __len__(self):
         return self.__hdr_len__ + len(self.wave) + len(self.mask)
@@ -552,13 +1084,13 @@ class Wave(Entry):
     # An array of sampled data
     __hdr__ = (("_length", "i", 0),)
 
+    fixed_size = False
+
     def unpack(self, buf: bytes):
         super().unpack(buf)
         self.data = b""
         assert self._length == 1024 or self._length == 2048
-        buf = buf[self.__hdr_len__ :]
-        sample_buf = buf[: 4 * self._length]
-        self.array = np.frombuffer(sample_buf, dtype=np.int32)
+        self.array = Cursor(buf, self.__hdr_len__).array(np.int32, self._length)
 
     def __len__(self):
         return self.__hdr_len__ + (4 * self._length)
@@ -572,18 +1104,16 @@ class Mask(Entry):
 
     __hdr__ = (("points", "i", 2),)
 
+    fixed_size = False
+
     def unpack(self, buf: bytes):
         super().unpack(buf)
-        buf = buf[self.__hdr_len__ :]
-        _len = 0
+        cursor = Cursor(buf, self.__hdr_len__)
         points = []
         for i in range(self.points):
-            p = MaskP(buf)
-            buf = buf[len(p) :]
-            points.append(p)
-            _len += len(p)
+            points.append(cursor.parse(MaskP))
 
-        self._len = _len
+        self._len = cursor.offset - self.__hdr_len__
 
     def __len__(self):
         return self.__hdr_len__ + self._len
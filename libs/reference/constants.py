@@ -13,6 +13,23 @@ COMPONENT_TYPE_MAP = {
 }
 
 
+# portal nominals known to be wrong, inspection slug -> corrected nominal
+# hallador units with bad nominals
+HALLADOR_NOMINAL_OVERRIDES = {
+    '20220523-332ac6': 0.28,
+    '20220523-64417d': 0.28,
+    '20221011-7c7e5f': 0.26,
+    '20221011-18c8e9': 0.26,
+}
+
+# gibson slopes nominal
+GIBSON_NOMINAL_OVERRIDES = {
+    '20221004-565f7b': 0.203,
+}
+
+NOMINAL_OVERRIDES = {**HALLADOR_NOMINAL_OVERRIDES, **GIBSON_NOMINAL_OVERRIDES}
+
+
 # Gecko customers identified as paper customers
 PAPER_CUST_LIST = [
     'Clearwater Paper',
@@ -0,0 +1,166 @@
+"""
+Multi-gate A-scan measurements over SquareData volumes
+
+Every (encoder, cycle) A-scan of `raw_paut_waveform_data` is measured in the
+three gates stored in the file (`Gates`): peak amplitude, threshold-crossing
+time of flight and the time difference between consecutive gates. The work is
+batched numpy over chunks of encoder positions, spread over a thread pool
+(the numpy reductions release the GIL).
+
+Assumptions about the Square format:
+- gate start/length, `ascan_start` and `sampling_period` share one time unit
+  (microseconds by default)
+- gate thresholds are a percentage of full screen height, i.e. of the largest
+  rectified sample value for `bit_size`
+- `vel_<k>` (m/s) is the velocity used for the thickness measured by gate k
+
+"""
+import concurrent.futures
+import os
+import typing as t
+
+import numpy as np
+
+from ..parsers.square_formats import Q_, SquareData, SquareDataStream
+
+
+N_GATES = 3
+
+
+def sampling_period_s(header, time_unit: str = "us") -> float:
+    """Sampling period of the A-scans in seconds"""
+    return Q_(header.contents["sampling_period"], time_unit).to("s").m
+
+
+def full_scale(header) -> int:
+    """Largest rectified amplitude of a sample"""
+    bit_size = header.contents.get("bit_size") or 8
+    return 2 ** (bit_size - 1) - 1
+
+
+def gate_windows(header, gates, time_unit: str = "us") -> t.List[t.Tuple[int, int, float]]:
+    """(start sample, stop sample, amplitude threshold) of each gate"""
+    period = header.contents["sampling_period"]
+    ascan_start = header.contents["ascan_start"]
+    num_points = header.contents["num_points"]
+    windows = []
+    for k in range(1, N_GATES + 1):
+        gate_start = gates.contents[f"gate{k}_start"]
+        gate_length = gates.contents[f"gate{k}_length"]
+        start = int(round((gate_start - ascan_start) / period))
+        stop = int(round((gate_start + gate_length - ascan_start) / period))
+        start = min(max(start, 0), num_points)
+        stop = min(max(stop, start), num_points)
+        threshold = gates.contents[f"gate{k}_thres"] / 100 * full_scale(header)
+        windows.append((start, stop, threshold))
+    return windows
+
+
+def rectify(ascans: np.ndarray) -> np.ndarray:
+    """Absolute amplitude of int8 samples, with -128 clipped to 127"""
+    return np.minimum(np.abs(ascans.astype(np.int16)), np.iinfo(ascans.dtype).max)
+
+
+def measure_chunk(ascans: np.ndarray, windows) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Peak amplitude and crossing sample of each gate for a block of A-scans
+
+    inputs:
+        - ascans - (n, num_cycles, num_points) raw samples
+        - windows - output of gate_windows
+    outputs:
+        - peaks - (N_GATES, n, num_cycles) peak rectified amplitude
+        - crossings - (N_GATES, n, num_cycles) index of the first sample at or
+          above the gate threshold, NaN if the gate was not crossed
+    """
+    shape = (len(windows),) + ascans.shape[:2]
+    peaks = np.zeros(shape, dtype=np.int16)
+    crossings = np.full(shape, np.nan, dtype=np.float32)
+    for k, (start, stop, threshold) in enumerate(windows):
+        if stop <= start:
+            continue
+        amplitude = rectify(ascans[:, :, start:stop])
+        peaks[k] = amplitude.max(axis=-1)
+        above = amplitude >= threshold
+        first = above.argmax(axis=-1)
+        crossings[k] = np.where(above.any(axis=-1), start + first, np.nan)
+    return peaks, crossings
+
+
+def _chunks(source, chunk_size: int) -> t.Iterator[t.Tuple[int, np.ndarray]]:
+    if isinstance(source, SquareDataStream):
+        for chunk in source:
+            yield chunk.encoder_start, chunk.raw_paut_waveform_data
+        return
+    volume = source.raw_paut_waveform_data
+    for start in range(0, volume.shape[0], chunk_size):
+        yield start, volume[start : start + chunk_size]
+
+
+def gate_cscans(
+    source: t.Union[SquareData, SquareDataStream],
+    chunk_size: int = 256,
+    max_workers: t.Optional[int] = None,
+    time_unit: str = "us",
+) -> t.Dict[str, np.ndarray]:
+    """
+    C-scans of the file's gates for a SquareData volume (or stream)
+
+    inputs:
+        - source - SquareData, or SquareDataStream to keep memory constant
+        - chunk_size - encoder positions per batch (ignored for streams, which
+          use their own chunk size)
+        - max_workers - threads measuring chunks in parallel
+        - time_unit - unit of the gate, ascan_start and sampling_period times
+    outputs:
+        - dict of (encoder_size, num_cycles) arrays:
+            - gate<k>_peak - peak rectified amplitude in gate k
+            - gate<k>_tof - threshold-crossing time of flight in s, NaN if
+              the gate was not crossed
+            - gate<k>_thickness - vel_<k> * gate<k>_tof / 2 in m
+            - gate<k>_gate<k-1>_dt - time difference between the crossings
+              of gate k and gate k-1 in s
+            - gate<k>_gate<k-1>_thickness - vel_<k> * dt / 2 in m
+    """
+    header = source.header
+    windows = gate_windows(header, source.gates, time_unit)
+    shape = (header.contents["encoder_size"], header.contents["num_cycles"])
+    peaks = np.zeros((N_GATES,) + shape, dtype=np.int16)
+    crossings = np.full((N_GATES,) + shape, np.nan, dtype=np.float32)
+
+    def measure(item):
+        start, ascans = item
+        peak, crossing = measure_chunk(ascans, windows)
+        peaks[:, start : start + len(ascans)] = peak
+        crossings[:, start : start + len(ascans)] = crossing
+
+    # Executor.map would read every chunk of a stream up front: keep at most
+    # 2*max_workers chunks in flight instead
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = set()
+        for item in _chunks(source, chunk_size):
+            pending.add(pool.submit(measure, item))
+            if len(pending) >= 2 * max_workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    # re-raises any exception from the workers
+                    future.result()
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+
+    # sample index -> time of flight
+    period = sampling_period_s(header, time_unit)
+    ascan_start = Q_(header.contents["ascan_start"], time_unit).to("s").m
+    tof = ascan_start + crossings.astype(np.float64) * period
+
+    cscans = {}
+    for k in range(1, N_GATES + 1):
+        velocity = header.contents[f"vel_{k}"]
+        cscans[f"gate{k}_peak"] = peaks[k - 1]
+        cscans[f"gate{k}_tof"] = tof[k - 1]
+        cscans[f"gate{k}_thickness"] = velocity * tof[k - 1] / 2
+        if k > 1:
+            dt = tof[k - 1] - tof[k - 2]
+            cscans[f"gate{k}_gate{k - 1}_dt"] = dt
+            cscans[f"gate{k}_gate{k - 1}_thickness"] = velocity * dt / 2
+    return cscans
@@ -0,0 +1,186 @@
+"""
+Sectorial-scan (S-scan) reconstruction of SquareData volumes
+
+Each focal law (cycle) is a straight beam leaving the wedge at
+`exits_array[cycle]` (mm along the surface) with refracted angle
+`angles_array[cycle]` (degrees from the surface normal). A sample at time t
+lies at half the specimen sound path, v * t / 2, along that beam.
+
+A lookup table mapping every image pixel to its nearest (cycle, sample) is
+built once per probe and setup and cached by the geometry parameters.
+Rendering is then a single batched gather over any number of encoder slices.
+
+Assumptions about the Square format:
+- `ascan_start` is referenced to the specimen surface (true depth mode), so
+  the wedge delay is already removed
+- `ascan_start` and `sampling_period` share one time unit (microseconds by
+  default) and `specimen_velocity` is in m/s
+
+"""
+import functools
+import typing as t
+
+import numpy as np
+
+from ..parsers.square_formats import Q_, SquareData
+from ..ut_analysis.gating import rectify
+
+
+class SectorialLUT:
+    """Pixel -> (cycle, sample) lookup table of one sectorial image
+
+    The image has shape (len(z), len(x)); `pixels` are the flat indices of the
+    pixels covered by a beam, `cycles` and `samples` their source sample.
+
+    """
+
+    x: np.ndarray
+    z: np.ndarray
+    pixels: np.ndarray
+    cycles: np.ndarray
+    samples: np.ndarray
+
+    def __init__(self, x, z, pixels, cycles, samples):
+        self.x = x
+        self.z = z
+        self.pixels = pixels
+        self.cycles = cycles
+        self.samples = samples
+
+    @property
+    def shape(self) -> t.Tuple[int, int]:
+        return len(self.z), len(self.x)
+
+
+@functools.lru_cache(maxsize=32)
+def _build_lut(
+    angles: t.Tuple[float, ...],
+    exits: t.Tuple[float, ...],
+    cycle_ids: t.Tuple[int, ...],
+    velocity_mm_s: float,
+    t0_s: float,
+    period_s: float,
+    num_points: int,
+    pixel_size: float,
+    block_size: int = 4096,
+) -> SectorialLUT:
+    theta = np.radians(np.asarray(angles))
+    exits = np.asarray(exits)
+    sin, cos = np.sin(theta), np.cos(theta)
+
+    # half sound path (mm) covered by the A-scan
+    r_min = max(velocity_mm_s * t0_s / 2, 0.0)
+    r_max = velocity_mm_s * (t0_s + (num_points - 1) * period_s) / 2
+
+    # image extent covering every beam
+    ends = np.concatenate([exits + r_min * sin, exits + r_max * sin, exits])
+    x = np.arange(ends.min(), ends.max() + pixel_size, pixel_size)
+    z = np.arange(0.0, r_max * cos.max() + pixel_size, pixel_size)
+
+    # a pixel belongs to the nearest beam if it is within half the spacing
+    # between adjacent beams (plus half a pixel)
+    if len(theta) > 1:
+        d_theta = np.median(np.abs(np.diff(theta)))
+        d_exit = np.median(np.abs(np.diff(exits)))
+    else:
+        d_theta = d_exit = 0.0
+
+    xx, zz = np.meshgrid(x, z)
+    xx, zz = xx.ravel(), zz.ravel()
+    pixels, cycles, samples = [], [], []
+    for start in range(0, len(xx), block_size):
+        px = xx[start : start + block_size, None] - exits[None, :]
+        pz = zz[start : start + block_size, None]
+        along = px * sin + pz * cos
+        across = np.abs(px * cos - pz * sin)
+        across = np.where(along > 0, across, np.inf)
+
+        nearest = across.argmin(axis=1)
+        rows = np.arange(len(nearest))
+        r = along[rows, nearest]
+        tolerance = (r * d_theta + d_exit + pixel_size) / 2
+        sample = np.rint((2 * r / velocity_mm_s - t0_s) / period_s)
+
+        valid = (across[rows, nearest] <= tolerance) & (sample >= 0) & (sample < num_points)
+        pixels.append(start + np.flatnonzero(valid))
+        cycles.append(np.asarray(cycle_ids)[nearest[valid]])
+        samples.append(sample[valid].astype(np.int64))
+
+    return SectorialLUT(
+        x, z, np.concatenate(pixels), np.concatenate(cycles), np.concatenate(samples)
+    )
+
+
+def probe_cycles(square: SquareData, probe: int) -> np.ndarray:
+    """Cycles (focal laws) fired by `probe`, read from the first encoder position"""
+    num_cycles = square.header.contents["num_cycles"]
+    return np.flatnonzero(np.asarray(square.probe_numbers_array[:num_cycles]) == probe)
+
+
+def sectorial_lut(
+    square: SquareData,
+    probe: int = 0,
+    cycles: t.Optional[t.Sequence[int]] = None,
+    pixel_size: float = 0.5,
+    time_unit: str = "us",
+) -> SectorialLUT:
+    """
+    Cached lookup table of the S-scan of one probe
+
+    inputs:
+        - square - SquareData (or anything with header/probe_data/angles/exits)
+        - probe - index into probe_data, for the specimen velocity
+        - cycles - cycles making up the sector, defaults to all cycles
+        - pixel_size - image resolution in mm
+        - time_unit - unit of ascan_start and sampling_period
+    outputs:
+        - SectorialLUT, shared by every call with the same geometry
+    """
+    header = square.header.contents
+    if cycles is None:
+        cycles = range(header["num_cycles"])
+    cycles = tuple(int(c) for c in cycles)
+
+    velocity = square.probe_data[probe].contents["specimen_velocity"]
+    return _build_lut(
+        tuple(float(square.angles_array[c]) for c in cycles),
+        tuple(float(square.exits_array[c]) for c in cycles),
+        cycles,
+        velocity * 1000.0,
+        Q_(header["ascan_start"], time_unit).to("s").m,
+        Q_(header["sampling_period"], time_unit).to("s").m,
+        header["num_points"],
+        pixel_size,
+    )
+
+
+def render_sectorial(
+    volume: np.ndarray,
+    lut: SectorialLUT,
+    chunk_size: int = 256,
+) -> np.ndarray:
+    """
+    Sectorial images of A-scan volume slices
+
+    inputs:
+        - volume - (num_cycles, num_points) for one encoder position, or
+          (n_encoders, num_cycles, num_points) e.g. raw_paut_waveform_data
+        - lut - from sectorial_lut
+        - chunk_size - encoder positions gathered at once
+    outputs:
+        - (nz, nx) or (n_encoders, nz, nx) rectified amplitude images, 0 where
+          no beam covers the pixel
+    """
+    single = volume.ndim == 2
+    if single:
+        volume = volume[None]
+
+    images = np.zeros((len(volume), lut.shape[0] * lut.shape[1]), dtype=np.int16)
+    for start in range(0, len(volume), chunk_size):
+        block = volume[start : start + chunk_size]
+        images[start : start + len(block), lut.pixels] = rectify(
+            block[:, lut.cycles, lut.samples]
+        )
+
+    images = images.reshape((len(volume),) + lut.shape)
+    return images[0] if single else images